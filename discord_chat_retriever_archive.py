@@ -0,0 +1,253 @@
+""" Compact binary archive format for long term storage of the messages of a channel (.dca)
+
+Layout:
+* MAGIC (5 bytes)
+* varint length + header: JSON object with the channel information, the record count and the codec
+* varint length + compressed author dictionary: JSON list of the distinct author objects
+* varint length + compressed record block, one record per message in snowflake order:
+    * varint snowflake delta (the first record stores the snowflake itself)
+    * varint author index + 1 (0 when the message has no author)
+    * varint length + content (UTF-8)
+    * varint length + compact JSON of the remaining fields ('{}' when there are none)
+
+The timestamp and the channel ID of a message are not stored when they can be derived from the snowflake
+and the header, the reader puts them back.
+"""
+
+from datetime import datetime, timezone
+
+import json
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MAGIC = b'DCA\x00\x01'
+DISCORD_EPOCH = 1420070400000
+DERIVED_FIELDS = ('id', 'author', 'content', 'timestamp', 'channel_id')
+
+
+def write_archive(path, header, messages, codec = 'zlib', level = 9):
+    """ Write messages to an archive file
+
+    Keyword Arguments:
+    * path: str -- Path of the archive file
+    * header: dict -- Channel information (see DiscordChatRetrieverDataHub._create_base_message_json)
+    * messages: iterable -- Discord message objects, in any order
+    * codec: str -- Compression of the author dictionary and the record block: 'zlib' or 'zstd'
+    * level: int -- Compression level
+    """
+
+    messages = sorted(messages, key = lambda message: int(message['id']))
+    header = {key: value for key, value in header.items() if key != 'messages'}
+    header['record_count'] = len(messages)
+    header['codec'] = codec
+
+    # Intern the authors, identical author objects share one dictionary entry
+    authors = []
+    author_indexes = {}
+    records = bytearray()
+    previous_snowflake = 0
+    for message in messages:
+        snowflake = int(message['id'])
+        records += _encode_varint(snowflake - previous_snowflake)
+        previous_snowflake = snowflake
+
+        author = message.get('author')
+        if author is None:
+            records += _encode_varint(0)
+        else:
+            author_key = json.dumps(author, sort_keys = True, separators = (',', ':'))
+            if author_key not in author_indexes:
+                author_indexes[author_key] = len(authors)
+                authors.append(author)
+            records += _encode_varint(author_indexes[author_key] + 1)
+
+        _append_bytes(records, (message.get('content') or '').encode('utf-8'))
+
+        # Keep the timestamp and the channel ID only if they can't be derived
+        extra = {key: value for key, value in message.items() if key not in DERIVED_FIELDS}
+        if 'content' in message and message['content'] is None:
+            extra['content'] = None
+        if 'content' not in message:
+            extra['_no_content'] = True
+        if 'timestamp' in message and message['timestamp'] != _snowflake_timestamp(snowflake):
+            extra['timestamp'] = message['timestamp']
+        if 'channel_id' in message and message['channel_id'] != header.get('channel_id'):
+            extra['channel_id'] = message['channel_id']
+        if 'timestamp' not in message:
+            extra['_no_timestamp'] = True
+        if 'channel_id' not in message:
+            extra['_no_channel_id'] = True
+        _append_bytes(records, json.dumps(extra, separators = (',', ':')).encode('utf-8'))
+
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(_length_prefixed(json.dumps(header, separators = (',', ':')).encode('utf-8')))
+        f.write(_length_prefixed(_compress(json.dumps(authors, separators = (',', ':')).encode('utf-8'), codec, level)))
+        f.write(_length_prefixed(_compress(bytes(records), codec, level)))
+
+
+def read_archive_header(path):
+    """ Read the header of an archive file
+
+    Keyword Arguments:
+    * path: str -- Path of the archive file
+
+    --------------------------------
+
+    Return Values:
+    * Header of the archive (channel information, record_count, codec)
+    """
+
+    with open(path, 'rb') as f:
+        _check_magic(f)
+        return json.loads(_read_length_prefixed(f))
+
+
+def iter_archive(path):
+    """ Stream the messages of an archive file in snowflake order
+
+    Keyword Arguments:
+    * path: str -- Path of the archive file
+
+    --------------------------------
+
+    Yield Values:
+    * Discord message objects, with their derived timestamp and channel ID restored
+    """
+
+    with open(path, 'rb') as f:
+        _check_magic(f)
+        header = json.loads(_read_length_prefixed(f))
+        authors = json.loads(_decompress(_read_length_prefixed(f), header['codec']))
+        records = _decompress(_read_length_prefixed(f), header['codec'])
+
+    offset = 0
+    snowflake = 0
+    for _ in range(header['record_count']):
+        delta, offset = _decode_varint(records, offset)
+        snowflake += delta
+        author_index, offset = _decode_varint(records, offset)
+        content, offset = _read_bytes(records, offset)
+        extra, offset = _read_bytes(records, offset)
+
+        message = {'id': str(snowflake)}
+        extra = json.loads(extra)
+        if not extra.pop('_no_channel_id', False):
+            message['channel_id'] = header.get('channel_id')
+        if author_index > 0:
+            message['author'] = authors[author_index - 1]
+        if not extra.pop('_no_content', False):
+            message['content'] = content.decode('utf-8')
+        if not extra.pop('_no_timestamp', False):
+            message['timestamp'] = _snowflake_timestamp(snowflake)
+        message.update(extra)
+        yield message
+
+
+def read_archive(path):
+    """ Read an archive file into the JSON object of a chunk
+
+    Keyword Arguments:
+    * path: str -- Path of the archive file
+
+    --------------------------------
+
+    Return Values:
+    * The JSON object of the chunk (see DiscordChatRetrieverDataHub._create_base_message_json)
+    """
+
+    chunk = read_archive_header(path)
+    chunk.pop('record_count')
+    chunk.pop('codec')
+    chunk['messages'] = list(iter_archive(path))
+    return chunk
+
+
+def _snowflake_timestamp(snowflake):
+    """ ISO 8601 timestamp of a snowflake, as Discord formats it """
+
+    milliseconds = (snowflake >> 22) + DISCORD_EPOCH
+    return datetime.fromtimestamp(milliseconds / 1000, tz = timezone.utc).isoformat(timespec = 'microseconds')
+
+
+def _compress(data, codec, level):
+    if codec == 'zlib':
+        return zlib.compress(data, level)
+    if codec == 'zstd':
+        if zstandard is None:
+            raise ValueError("zstd compression requires the zstandard package")
+        return zstandard.ZstdCompressor(level = level).compress(data)
+    raise ValueError("Unknown archive codec: {}".format(codec))
+
+
+def _decompress(data, codec):
+    if codec == 'zlib':
+        return zlib.decompress(data)
+    if codec == 'zstd':
+        if zstandard is None:
+            raise ValueError("zstd decompression requires the zstandard package")
+        return zstandard.ZstdDecompressor().decompress(data)
+    raise ValueError("Unknown archive codec: {}".format(codec))
+
+
+def _check_magic(f):
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError("Not a message archive: {}".format(f.name))
+
+
+def _encode_varint(value):
+    """ Unsigned LEB128 encoding of an integer """
+
+    encoded = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            encoded.append(byte | 0x80)
+        else:
+            encoded.append(byte)
+            return bytes(encoded)
+
+
+def _decode_varint(data, offset):
+    """ Decode an unsigned LEB128 integer, returns the value and the offset after it """
+
+    value = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, offset
+        shift += 7
+
+
+def _append_bytes(buffer, data):
+    buffer += _encode_varint(len(data))
+    buffer += data
+
+
+def _read_bytes(data, offset):
+    length, offset = _decode_varint(data, offset)
+    return data[offset : offset + length], offset + length
+
+
+def _length_prefixed(data):
+    return _encode_varint(len(data)) + data
+
+
+def _read_length_prefixed(f):
+    length = 0
+    shift = 0
+    while True:
+        byte = f.read(1)[0]
+        length |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            break
+        shift += 7
+    return f.read(length)
@@ -0,0 +1,342 @@
+from concurrent.futures import ThreadPoolExecutor
+from discord_chat_retriever_archive import write_archive
+from google.api_core import exceptions
+from google.cloud import storage
+
+import json
+import logging
+import os
+import re
+import threading
+
+class DiscordChatRetrieverCompactor:
+
+    ###############################################
+    #####               CONSTANTS             #####
+    ###############################################
+    DATA_PREFIX = 'data/'
+    ARCHIVE_FOLDER = 'archive/'
+    WORK_FOLDER = 'compaction/'
+    MESSAGES_PER_ARCHIVE = 50000
+    MAX_PARALLEL_CHANNELS = 8
+
+    # data/YYYY-MM-DD/{channel}_{suffix}.json[l][.gz|.zst] or .dca
+    CHUNK_NAME_PATTERN = re.compile(r'^data/(\d{4}-\d{2}-\d{2})/(\d+)_[^/]+(\.jsonl?(\.gz|\.zst)?|\.dca)$')
+
+    # data/YYYY-MM-DD/users/{channel}_{first}_{last}.json[.gz|.zst], written when users are normalized
+    USERS_NAME_PATTERN = re.compile(r'^data/(\d{4}-\d{2}-\d{2})/users/(\d+)_[^/]+\.json(\.gz|\.zst)?$')
+
+    def __init__(self, data_hub):
+        """ Offline job merging the small chunk objects of a channel into large snowflake ordered archives
+
+        Keyword Arguments:
+        * data_hub: DiscordChatRetrieverDataHub -- Data hub used for reading/writing chunks and manifests
+        """
+
+        self.data_hub = data_hub
+
+        # Format of the archives: 'json' (JSON compressed with compression) or 'dca' (compact binary archive,
+        # see discord_chat_retriever_archive)
+        self.archive_format = 'json'
+        self.compression = 'gzip'
+
+        # Day index updates are shared between channels, serialize them to avoid retry storms
+        self.manifest_lock = threading.Lock()
+
+
+    def compact(self):
+        """ Compact the chunks of every channel found under the data prefix
+
+        Steps:
+        1. List the chunk objects and the users files in GCP Storage and group them by channel
+        2. Compact the channels in parallel (see compact_channel)
+        """
+
+        logging.info("Compacting chunks (Bucket: {}, Prefix: {})".format(self.data_hub.BUCKET_NAME, self.DATA_PREFIX))
+
+        # List the chunk objects and group them by channel
+        storage_client = storage.Client()
+        bucket = storage_client.bucket(self.data_hub.BUCKET_NAME)
+        chunks_per_channel = {}
+        users_files_per_channel = {}
+        for blob in bucket.list_blobs(prefix = self.DATA_PREFIX):
+            match = self.CHUNK_NAME_PATTERN.match(blob.name)
+            if match is not None:
+                chunks_per_channel.setdefault(match.group(2), []).append((blob.name, blob.generation))
+                continue
+            match = self.USERS_NAME_PATTERN.match(blob.name)
+            if match is not None:
+                users_files_per_channel.setdefault(match.group(2), []).append((blob.name, blob.generation))
+
+        logging.info("Found chunks for {} channels".format(len(chunks_per_channel)))
+
+        # Compact the channels in parallel
+        with ThreadPoolExecutor(max_workers = self.MAX_PARALLEL_CHANNELS) as executor:
+            futures = {executor.submit(self.compact_channel, channel, chunks, users_files_per_channel.get(channel, [])): channel
+                        for channel, chunks in chunks_per_channel.items()}
+            for future in futures:
+                try:
+                    future.result()
+                except BaseException as e:
+                    logging.error("Error while compacting channel {}: {}".format(futures[future], e))
+
+
+    def compact_channel(self, channel, chunks, users_files = ()):
+        """ Merge the chunks of a channel with its current archives and swap the new archives in
+
+        Keyword Arguments:
+        * channel: str -- Channel ID
+        * chunks: list -- (blob name, generation) of the chunk objects to compact
+        * users_files: list -- (blob name, generation) of the users files of the chunks (normalized users)
+
+        --------------------------------
+
+        Steps:
+        1. Download the chunks, then the current archives of the channel whose snowflake range overlaps the
+        chunks (and the newest archive before them if it isn't full), the other archives are kept as they are
+        2. Merge the messages, dropping duplicates by snowflake, and sort them by snowflake
+        3. Upload the new archives (archive/{channel}/{first}_{last}.json.gz or .dca), with the users their
+        messages reference by ID in archive/{channel}/users/{first}_{last}.json.gz when users are normalized
+        4. Swap the archive index (archive/{channel}/index.json) with a generation precondition, readers
+        only see the new archives from this point
+        5. Delete the compacted chunks, their users files and the archives that are no longer referenced
+        """
+
+        logging.info("Compacting {} chunks of channel {}".format(len(chunks), channel))
+
+        storage_client = storage.Client()
+        bucket = storage_client.bucket(self.data_hub.BUCKET_NAME)
+        work_folder = self.WORK_FOLDER + '{}/'.format(channel)
+        index_name = self.ARCHIVE_FOLDER + '{}/index.json'.format(channel)
+
+        try:
+            # Read the current archive index
+            index_blob = bucket.get_blob(index_name)
+            index_generation = 0 if index_blob is None else index_blob.generation
+            old_archives = [] if index_blob is None else self.data_hub._read_json_blob(index_blob)['archives']
+
+            # Download the chunks and merge their messages by snowflake, later chunks win
+            header = None
+            chunk_messages = {}
+            for name, generation in chunks:
+                chunk = self._download_chunk(bucket, work_folder, name)
+                if header is None:
+                    header = {key: value for key, value in chunk.items() if key != 'messages'}
+                for message in chunk['messages']:
+                    chunk_messages[int(message['id'])] = message
+
+            if header is None:
+                return
+
+            # Only the archives overlapping the chunks are rewritten, the history before and after them is kept
+            rewritten_archives = []
+            if len(chunk_messages) > 0:
+                rewritten_archives = self._archives_to_rewrite(old_archives, min(chunk_messages), max(chunk_messages))
+            rewritten_names = set(archive['object'] for archive in rewritten_archives)
+            kept_archives = [archive for archive in old_archives if archive['object'] not in rewritten_names]
+
+            # The chunks win over the archives
+            messages = {}
+            users = {}
+            for archive in rewritten_archives:
+                for message in self._download_chunk(bucket, work_folder, archive['object'])['messages']:
+                    messages[int(message['id'])] = message
+                if 'users_object' in archive:
+                    users.update(self._download_users(bucket, work_folder, archive['users_object']))
+            messages.update(chunk_messages)
+
+            # Users of the chunks, the newest version of a user wins
+            for name, generation in sorted(users_files):
+                users.update(self._download_users(bucket, work_folder, name))
+
+            # Write and upload the new archives in snowflake order
+            snowflakes = sorted(messages)
+            new_archives = []
+            for start in range(0, len(snowflakes), self.MESSAGES_PER_ARCHIVE):
+                archive = dict(header)
+                archive['messages'] = [messages[snowflake] for snowflake in snowflakes[start : start + self.MESSAGES_PER_ARCHIVE]]
+                first_snowflake = archive['messages'][0]['id']
+                last_snowflake = archive['messages'][-1]['id']
+
+                if self.archive_format == 'dca':
+                    object_name = self.ARCHIVE_FOLDER + '{}/{}_{}.dca'.format(channel, first_snowflake, last_snowflake)
+                    self.data_hub._create_folder(os.path.dirname(work_folder + object_name))
+                    write_archive(work_folder + object_name, header, archive['messages'])
+                else:
+                    object_name = self.ARCHIVE_FOLDER + '{}/{}_{}.json{}'.format(
+                        channel,
+                        first_snowflake,
+                        last_snowflake,
+                        self.data_hub.COMPRESSION_EXTENSIONS[self.compression])
+                    self.data_hub._write_file(work_folder + object_name, archive, self.compression)
+                byte_size = os.path.getsize(work_folder + object_name)
+                self.data_hub._upload_file(self.data_hub.BUCKET_NAME, work_folder + object_name, object_name)
+                os.remove(work_folder + object_name)
+
+                entry = {
+                    'object': object_name,
+                    'first_snowflake': first_snowflake,
+                    'last_snowflake': last_snowflake,
+                    'message_count': len(archive['messages']),
+                    'byte_size': byte_size
+                }
+
+                # Users referenced by ID in the messages of the archive, stored next to it
+                archive_users = [users[user_id] for user_id in sorted(self._referenced_user_ids(archive['messages']))
+                                    if user_id in users]
+                if len(archive_users) > 0:
+                    users_object_name = self.ARCHIVE_FOLDER + '{}/users/{}_{}.json{}'.format(
+                        channel,
+                        first_snowflake,
+                        last_snowflake,
+                        self.data_hub.COMPRESSION_EXTENSIONS[self.compression])
+                    self.data_hub._write_file(work_folder + users_object_name, archive_users, self.compression)
+                    self.data_hub._upload_file(self.data_hub.BUCKET_NAME, work_folder + users_object_name, users_object_name)
+                    os.remove(work_folder + users_object_name)
+                    entry['users_object'] = users_object_name
+
+                new_archives.append(entry)
+
+            # Swap the archive index atomically, fails if another compaction swapped it in the meantime
+            index = dict(header)
+            index['archives'] = sorted(kept_archives + new_archives, key = lambda archive: int(archive['first_snowflake']))
+            try:
+                self.data_hub._write_json_blob(index_name, index, index_generation)
+            except exceptions.PreconditionFailed:
+                logging.error("Archive index of channel {} changed during compaction, aborting".format(channel))
+                return
+
+            # Delete the compacted chunks (unless they were rewritten since the listing)
+            compacted_per_day = {}
+            for name, generation in chunks:
+                try:
+                    bucket.delete_blob(name, if_generation_match = generation)
+                except (exceptions.NotFound, exceptions.PreconditionFailed):
+                    logging.warning("Chunk {} changed or vanished, not deleting it".format(name))
+                    continue
+                day = self.CHUNK_NAME_PATTERN.match(name).group(1)
+                compacted_per_day.setdefault(day, []).append(name)
+
+            # The users of the compacted chunks are in the users files of the archives now
+            for name, generation in users_files:
+                try:
+                    bucket.delete_blob(name, if_generation_match = generation)
+                except (exceptions.NotFound, exceptions.PreconditionFailed):
+                    logging.warning("Users file {} changed or vanished, not deleting it".format(name))
+
+            # Delete the archives (and their users files) replaced by the new ones
+            new_archive_names = set(a['object'] for a in new_archives) | set(a.get('users_object') for a in new_archives)
+            for archive in rewritten_archives:
+                for name in (archive['object'], archive.get('users_object')):
+                    if name is not None and name not in new_archive_names:
+                        try:
+                            bucket.delete_blob(name)
+                        except exceptions.NotFound:
+                            pass
+
+            # The daily manifests no longer reference the compacted chunks
+            with self.manifest_lock:
+                for day, names in compacted_per_day.items():
+                    self.data_hub._remove_chunks_from_manifests(self.data_hub.MANIFEST_FOLDER.format(day), channel, names)
+
+            logging.info("Compacted channel {}: rewrote {} archives into {} ({} messages), kept {} archives".format(
+                channel,
+                len(rewritten_archives),
+                len(new_archives),
+                len(snowflakes),
+                len(kept_archives)))
+        finally:
+            self.data_hub.delete_folder(work_folder)
+
+
+    def _download_chunk(self, bucket, work_folder, name):
+        """ Download and read a chunk or archive object
+
+        Keyword Arguments:
+        * bucket: google.cloud.storage.Bucket -- Bucket of the object
+        * work_folder: str -- Local folder the object is downloaded to
+        * name: str -- Name of the object
+
+        --------------------------------
+
+        Return Values:
+        * The JSON object of the chunk (see DiscordChatRetrieverDataHub._read_chunk_file)
+        """
+
+        local_path = work_folder + name
+        self.data_hub._create_folder(os.path.dirname(local_path))
+
+        # Download the stored bytes, objects uploaded with a Content-Encoding would be decompressed otherwise
+        bucket.blob(name).download_to_filename(local_path, raw_download = True)
+        chunk = self.data_hub._read_chunk_file(local_path)
+        os.remove(local_path)
+        return chunk
+
+
+    def _download_users(self, bucket, work_folder, name):
+        """ Download and read a users file (a JSON list of Discord user objects)
+
+        Keyword Arguments:
+        * bucket: google.cloud.storage.Bucket -- Bucket of the object
+        * work_folder: str -- Local folder the object is downloaded to
+        * name: str -- Name of the object
+
+        --------------------------------
+
+        Return Values:
+        * Dict of the users by ID
+        """
+
+        local_path = work_folder + name
+        self.data_hub._create_folder(os.path.dirname(local_path))
+        bucket.blob(name).download_to_filename(local_path, raw_download = True)
+        with self.data_hub._open_input_file(local_path) as f:
+            users = json.load(f)
+        os.remove(local_path)
+        return {user['id']: user for user in users}
+
+
+    def _referenced_user_ids(self, messages):
+        """ IDs of the users referenced by ID in messages with normalized users (author, mentions, and those of
+        the referenced messages), see DiscordChatRetrieverDataHub._normalize_users
+
+        Keyword Arguments:
+        * messages: list -- Discord message objects
+        """
+
+        user_ids = set()
+        for message in messages:
+            while isinstance(message, dict):
+                if isinstance(message.get('author'), str):
+                    user_ids.add(message['author'])
+                user_ids.update(user for user in message.get('mentions') or () if isinstance(user, str))
+                message = message.get('referenced_message')
+        return user_ids
+
+
+    def _archives_to_rewrite(self, archives, first_snowflake, last_snowflake):
+        """ Archives to merge with chunks spanning a snowflake range: those overlapping the range, and the 
+        newest archive before the range if it isn't full (new messages would start a small archive otherwise)
+
+        Keyword Arguments:
+        * archives: list -- Entries of the archive index
+        * first_snowflake: int -- Oldest snowflake of the chunks
+        * last_snowflake: int -- Newest snowflake of the chunks
+
+        --------------------------------
+
+        Return Values:
+        * List of the archive entries to rewrite
+        """
+
+        rewritten = [archive for archive in archives
+                        if int(archive['first_snowflake']) <= last_snowflake and int(archive['last_snowflake']) >= first_snowflake]
+
+        # The archives are disjoint, the one before the range is the one with the newest snowflake
+        previous = [archive for archive in archives if int(archive['last_snowflake']) < first_snowflake]
+        if len(previous) > 0:
+            newest = max(previous, key = lambda archive: int(archive['last_snowflake']))
+            if newest['message_count'] < self.MESSAGES_PER_ARCHIVE:
+                rewritten.append(newest)
+
+        return rewritten
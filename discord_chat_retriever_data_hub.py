@@ -1,15 +1,36 @@
+from cachetools import LRUCache
+from collections import deque
+from concurrent import futures
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from discord_chat_retriever_archive import read_archive
+from discord_chat_retriever_filters import PageFilter, filter_page_in_worker, init_filter_worker, search_params_for_query
+from discord_chat_retriever_media import MEDIA_MANIFESTS, MediaDownloadPool
+from discord_chat_retriever_projection import compile_projection
+from discord_chat_retriever_records import MessageRecord
+from discord_chat_retriever_sinks import CHUNK_SINKS, SQLiteMessageStore
+from google.api_core import exceptions
 from google.cloud import storage
 
+import base64
 import glob
+import gzip
+import hashlib
+import io
 import json
 import logging
+import multiprocessing
 import os
 import re
 import requests
 import shutil
 import time
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 class DiscordChatRetrieverDataHub:
 
     ###############################################
@@ -23,6 +44,36 @@ class DiscordChatRetrieverDataHub:
     BUCKET_NAME = 'discordchatexporter'
     LOG_FILE_NAME = 'discord_chat_retriever_data_hub.log'
     NUM_MESSAGES_PER_FILE = 500
+    MAX_BYTES_PER_FILE = None # Rotate chunks by uncompressed byte size too, e.g. 16777216 (16MB)
+    MANIFEST_FOLDER = 'manifests/{}/' # Day of the data folder of the chunks
+    MANIFEST_UPDATE_RETRIES = 5
+    MEDIA_BLOCK_SIZE = 1048576 # 1MB
+    MEDIA_DOWNLOAD_RETRIES = 5
+    MEDIA_TIMEOUT = 60
+    UPLOAD_CHUNK_SIZE = 8388608 # 8MB, must be a multiple of 256KB
+    COMPRESSION_EXTENSIONS = {'gzip': '.gz', 'zstd': '.zst'}
+    COMPRESSED_CONTENT_TYPES = {'.gz': 'application/gzip', '.zst': 'application/zstd'}
+    CACHE_FOLDER = 'cache/'
+    MEDIA_PARTIAL_FOLDER = CACHE_FOLDER + 'media_partial/'
+    SETTINGS_FILE = 'configs/crawler_settings.json'
+    SETTINGS = ['download_attachments', 'download_attachments_MAX_SIZE', 'download_attachments_content_types', 
+                'regex_filter_expression', 'output_format', 'output_compression', 'output_compression_level', 
+                'fsync_on_rotate', 'parquet_time_window', 'parquet_row_group_size', 'message_store_path', 
+                'message_store_batch_size', 'message_projection', 'normalize_users', 'user_table_size', 
+                'message_filter', 'search_pushdown', 'filter_workers', 'filter_prefetch_pages', 
+                'raw_archive', 'raw_archive_format', 'media_workers', 'media_queue_size', 
+                'media_requests_per_second', 'media_derivatives', 'media_derivative_format', 
+                'media_derivative_quality', 'media_thumbnail_size', 'media_max_dimension', 
+                'media_replace_original_over', 'media_derivative_workers', 'media_manifest_format']
+    MEDIA_MANIFEST_FILE = CACHE_FOLDER + 'media_manifest{}' # Extension of the manifest format
+    MEDIA_MANIFEST_OBJECT = 'manifests/{}/media/{}{}' # Day of the data folder, end of the run, extension
+    RUN_REPORT_FILE = CACHE_FOLDER + 'run_report.jsonl'
+    RAW_FOLDER = 'raw/{}/' # Day of the data folder of the chunks
+    RAW_FORMATS = ['json', 'jsonl', 'archive'] # Formats the reprocess mode can read
+    CONFIG_SYNC_STATE_FILE = CACHE_FOLDER + 'config_sync_state.json'
+    COMMIT_LOG_FILE = 'configs/chunk_commit_log.json'
+    SEARCH_PAGE_SIZE = 25 # Results per page of the guild message search
+    SEARCH_INDEX_RETRY_SEC = 2 # Wait while the search index of a guild is built, unless the API says otherwise
 
     def __init__(self):
 
@@ -30,16 +81,111 @@ class DiscordChatRetrieverDataHub:
         self.requests_per_second = 0
         self.start_time = time.time_ns()
         self.download_attachments = False
-        self.download_attachments_MAX_SIZE = 8388608 #8MB
+        self.download_attachments_MAX_SIZE = None # No limit, large files are streamed
+        self.download_attachments_content_types = None # MIME types to download ('image/*' for any image), None for all
+
+        # Attachments are downloaded by a pool of threads while the messages are crawled (see 
+        # discord_chat_retriever_media), with a request budget of their own on the CDN (None for no limit)
+        self.media_workers = 4
+        self.media_queue_size = 100
+        self.media_requests_per_second = 20
+        self.media_pool = None
+
+        # Downloads of the attachments of the messages between the media pool and the chunk sink (message ID 
+        # -> futures, see MediaDownloadPool.submit)
+        self.pending_media = {}
+
+        # Thumbnails and transcodes of the image attachments, created next to the originals in a process pool
+        # (Pillow). Originals larger than media_replace_original_over bytes are replaced by their transcode if 
+        # it is smaller (None keeps every original). The dimensions are recorded in the media manifest.
+        self.media_derivatives = False
+        self.media_derivative_format = 'webp' # 'webp' or 'jpeg'
+        self.media_derivative_quality = 80
+        self.media_thumbnail_size = 256
+        self.media_max_dimension = 2048
+        self.media_replace_original_over = None
+        self.media_derivative_workers = None # One per core
+
+        # Format of the media manifest of the run: 'jsonl' or 'sqlite' (see discord_chat_retriever_media)
+        self.media_manifest_format = 'jsonl'
         
         # Sample search expression 
         self.regex_filter_expression = [] 
 
+        # Structured filter query (see discord_chat_retriever_filters.compile_query), replaces the regex filters 
+        # and keeps messages without content when set, e.g. {"or": [{"has_attachment": true}, {"content": ["bug"]}]}
+        self.message_filter = None
+
+        # Filters of the run compiled from message_filter or regex_filter_expression (see _load_crawler_settings)
+        self.page_filter = None
+
+        # Processes filtering the pages while the next pages are fetched (0 filters in the extraction thread),
+        # for expensive filters, e.g. hundreds of regexes. Pages in flight per process.
+        self.filter_workers = 0
+        self.filter_prefetch_pages = 2
+        self.filter_executor = None
+
+        # Keep every crawled message, before the filters and the projection, in raw/YYYY-MM-DD/ so that new
+        # filters can be applied offline (see discord_chat_retriever_reprocessor), in one of RAW_FORMATS
+        self.raw_archive = False
+        self.raw_archive_format = 'jsonl'
+
+        # Fetch only the messages returned by the guild message search for message_filter when it can be 
+        # translated (see discord_chat_retriever_filters.search_params_for_query), the results are checked with
+        # the query again. The search matches whole words, a content keyword inside a word is not found.
+        self.search_pushdown = False
+        self.search_params = None
+
+        # Compression of the chunk files: None (pretty printed JSON), 'gzip' or 'zstd' (compact JSON)
+        # The level defaults to the codec default when None (gzip: 1-9, zstd: 1-22)
+        self.output_compression = None
+        self.output_compression_level = None
+
+        # Format of the chunk files: 'json' (one JSON object per chunk), 'jsonl' (JSON Lines, written 
+        # incrementally), 'parquet' (columnar, per time window) or 'archive' (compact binary archive), 
+        # see discord_chat_retriever_sinks
+        self.output_format = 'json'
+
+        # Parquet output: time window of a file ('day' or 'month') and rows per row group
+        self.parquet_time_window = 'day'
+        self.parquet_row_group_size = 10000
+
+        # Flush every chunk file to disk when it is rotated
+        self.fsync_on_rotate = False
+
+        # Local SQLite copy of the extracted messages (None to disable), e.g. CACHE_FOLDER + 'messages.sqlite3'
+        self.message_store_path = None
+        self.message_store_batch_size = 1000
+        self.message_store = None
+
+        # Fields of the messages to keep (dotted paths, e.g. 'author.id'), None keeps the whole message
+        self.message_projection = None
+        self.message_projector = None
+
+        # Store users once per chunk in a users file and reference them by ID in the messages (author, 
+        # mentions), the encoded users are kept in an LRU table for the run
+        self.normalize_users = False
+        self.user_table_size = 10000
+        self.user_table = None
+
+        # Report of the channel being extracted (see _new_channel_report), written to RUN_REPORT_FILE when the
+        # channel is done and uploaded with the logs
+        self.run_started = datetime.now()
+        self.channel_report = None
+        self.run_report_written = False
+
+        # Chunks committed for the channels being extracted (see _log_committed_chunk)
+        self.commit_log = {}
+
+        # Cached manifest objects (blob name -> (generation, manifest)) to avoid re-reading them per chunk
+        self.manifest_cache = {}
+
         # URL endpoints for Discord API
         self.urls = {
             'guilds': 'users/@me/guilds',
             'channels': 'guilds/{}/channels',
-            'messages': 'channels/{}/messages'
+            'messages': 'channels/{}/messages',
+            'search': 'guilds/{}/messages/search'
         }
 
         # Endpoint parameters
@@ -61,7 +207,7 @@ class DiscordChatRetrieverDataHub:
         """ Update the config file with the latest data
 
         Steps:
-        1. Download the config files from GCP Storage
+        1. Sync the config files from GCP Storage (only changed blobs are downloaded)
         2. Loop though every user in the config file
             Loop through every guild
                 If guild not in config file, add it
@@ -73,7 +219,7 @@ class DiscordChatRetrieverDataHub:
             If channel status is still 'processing', set status as 'inactive'
             f channel 'latest_message_id' is null, set status as 'inactive'
         4. Write the updated JSON to the config file
-        5. Upload the config file to GCP Storage
+        5. Sync the config files back to GCP Storage (only changed files are uploaded)
 
         ----------------------------------
 
@@ -86,8 +232,8 @@ class DiscordChatRetrieverDataHub:
 
         logging.info("Updating configs")
 
-        # Download the config files from GCP Storage
-        self._download_folder(self.BUCKET_NAME, 'configs/', 'configs/')
+        # Sync the config files from GCP Storage
+        self._sync_folder_down(self.BUCKET_NAME, 'configs/', 'configs/')
 
         # Read the config files
         user_token = self._read_config_as_json()
@@ -156,8 +302,8 @@ class DiscordChatRetrieverDataHub:
         # Write the updated config file
         self._write_file('configs/user_server_channel_DO_NOT_EDIT.json', user_server_channel)
 
-        # Upload the updated config file to GCP Storage
-        self._upload_folder(self.BUCKET_NAME, 'configs/', 'configs/')
+        # Sync the updated config file to GCP Storage
+        self._sync_folder_up(self.BUCKET_NAME, 'configs/', 'configs/')
         logging.info('Configs updated')
     
 
@@ -169,32 +315,16 @@ class DiscordChatRetrieverDataHub:
         2. Loop through every user in the user_server_channel config file
         3. Loop through every guild
         4. Loop through every channel and check if the status is 'processing'
-                * Get the last message timestamp from the config file
-                * Set BEFORE param to the latest message timestamp
-                * Request the latest messages from the channel
-                    * If the latest message timestamp is <= than the last message processed 
-                    timestamp from the config file, ignore the channel
-                    * Else, create a new JSON object for the channel and write the messages to it
-                    Update the BEFORE param to the latest processed message timestamp
-                * Do this until a message is found which has a timestamp <= than the last message processed timestamp
-                    * Request the messages before the BEFORE param
-                    * Loop through every message and check if the timestamp is <= than the last message processed timestamp
-                        * If a message is found, break both the loops
-                        * Else, write the messages to the JSON object and update the BEFORE param
-                * Reverse the messages in the JSON object so that the messages are in chronological order
+                * Stream the messages newer than the last processed message through the extraction 
+                pipeline (see _extract_channel)
                 * Update the config file
-                    * Update the last_processed timestamp in the config file to the latest message timestamp
+                    * Update the last_processed in the config file to the latest message crawled
                     * Update the status to 'processed'
-                * Write the JSON object to a file
         5. Write the updated config file
-        6. Upload the update file to GCP Storage
-                * Upload the config folder to GCP Storage
-                * Upload the Data folder to GCP Storage
+        6. Sync the config folder to GCP Storage
         
         -----------------------------------------------
 
-        TODO: Upload the config file to GCP Storage
-
         TODO: 
             * Introduce global time limit for the script
                 * If the script has been running for more than 10 minutes (yet to be decided), trigger a new 
@@ -205,154 +335,7 @@ class DiscordChatRetrieverDataHub:
                 status of 'new'
         """
 
-
-        logging.info("Downloading configs")
-
-        # Download the config file from GCP Storage
-        # download_folder(BUCKET_NAME, 'configs/', 'configs/')
-
-        # Read the config file
-        user_token = self._read_config_as_json()
-        user_server_channel = self._read_config_as_json('configs/user_server_channel_DO_NOT_EDIT.json')
-
-        # Loop through every user in the user_server_channel config file
-        for user in user_server_channel:
-            # Loop through every guild
-            for guild in user_server_channel[user]:
-                # Loop through every channel and check if the status is 'processing'
-                for channel in user_server_channel[user][guild]:
-
-                    try:
-                        # Check if the status is 'processing'
-                        if user_server_channel[user][guild][channel]['status'] == 'processing':
-                            logging.info('Extracting messages from channel (User: {}, Guild: {}, Channel: {})'.format(
-                                user, 
-                                guild, 
-                                channel))
-
-                            # Get the last message timestamp from the config file
-                            last_proccessed_timestamp = self._twitter_snowflake_to_datetime(user_server_channel[user][guild][channel]['last_processed'])
-                            
-                            # Create a new JSON object for the channel
-                            messages_json = self._create_base_message_json(user, guild, channel, user_server_channel[user][guild][channel]['name'])
-                            
-                            # Request the latest messages from the channel
-                            messages = self._request_url_response(self.BASE_URL + self.urls['messages'].format(channel), 
-                                                            user_token[user]['token'], 
-                                                            {'limit': 1})
-                            
-                            # If the latest message timestamp is <= than the last message processed, ignore the channel
-                            current_timestamp = self._twitter_snowflake_to_datetime(messages[0]['id'])
-                            if current_timestamp <= last_proccessed_timestamp:
-                                user_server_channel[user][guild][channel]['status'] = 'processed'
-                                continue
-
-                            # Update the JSON object with the messages if the message passes the regex filters
-                            if self._check_filters_on_message(messages[0]):
-                                messages_json['messages'] = messages
-                                if "attachments" in messages[0]:
-                                    for attachment in messages[0]["attachments"]:
-                                        if 'url' in attachment:
-                                            self._download_content(attachment['url'], self.DATA_FOLDER_MEDIA)
-                            else:
-                                messages_json['messages'] = []
-
-                            # Set the BEFORE param to the timestamp of the latest message processed
-                            last_message_processed = messages_json['messages'][0]['id']
-                            
-                            print("Processing channel: {}".format(user_server_channel[user][guild][channel]['name']))
-
-                            # Also, save the latest message ID to store in the config file
-                            latest_message_processed = messages_json['messages'][-1]['id']
-                            
-                            check = True
-                            while (check):
-
-                                # Get the 'message' endpoint params and set the before param to the last message processed
-                                params = self.url_params['messages'].copy()
-                                params['before'] = last_message_processed
-                                
-                                # Request the messages before the BEFORE param
-                                messages = self._request_url_response(self.BASE_URL + self.urls['messages'].format(channel), 
-                                                                user_token[user]['token'], 
-                                                                params)
-                                
-                                # Loop through every message and check if the timestamp is <= than the last message processed timestamp
-                                temporary_messages_holder = []
-                                for message in messages:
-
-                                    current_timestamp = self._twitter_snowflake_to_datetime(message['id'])
-                                    if current_timestamp <= last_proccessed_timestamp:
-                                        # If a message is found smaller than the last message processed timestamp, break both 
-                                        # the loops
-                                        check = False
-                                        break
-                                    
-                                    # Write the messages to the holder if the message passes the regex filters
-                                    if self._check_filters_on_message(message):
-                                        temporary_messages_holder.append(message)
-                                        if "attachments" in message:
-                                            for attachment in message["attachments"]:
-                                                if 'url' in attachment:
-                                                    self._download_content(attachment['url'], self.DATA_FOLDER_MEDIA)
-
-                                # Update the BEFORE param to the last message processed
-                                last_message_processed = messages[-1]['id']
-
-                                # Update the JSON object with the messages
-                                messages_json['messages'] += temporary_messages_holder
-
-                                # Mini-batch: Write the JSON object to a file for every specific number of messages
-                                if len(messages_json['messages']) > self.NUM_MESSAGES_PER_FILE:
-                                    # Reverse the messages in the JSON object so that the messages are in chronological order
-                                    messages_json['messages'].reverse()
-
-                                    # Get current time string
-                                    timestr = datetime.now().strftime("%Y%m%d-%H%M%S%f")
-
-                                    # Write the JSON object to a file
-                                    self._write_file(self.DATA_FOLDER + '{}_{}.json'.format(channel, timestr), messages_json)
-
-                                    # Upload the Data folder to GCP Storage
-                                    logging.info('Uploading extracted messages')
-                                    self._upload_folder(self.BUCKET_NAME, self.DATA_FOLDER, self.DATA_FOLDER)
-
-                                    # delete uploaded files
-                                    self.delete_folder(self.DATA_FOLDER)
-
-                                    # Initialize messages in the JSON object
-                                    messages_json['messages'] = []
-
-                            # Upload the rest of files that were not processed by mini-batches
-                            if len(messages_json['messages']) > 0:
-                                # Reverse the messages in the JSON object so that the messages are in chronological order
-                                messages_json['messages'].reverse()
-
-                                # Get current time string
-                                timestr = datetime.now().strftime("%Y%m%d-%H%M%S%f")
-
-                                # Write the JSON object to a file
-                                self._write_file(self.DATA_FOLDER + '{}_{}.json'.format(channel, timestr), messages_json)
-
-                                # Upload the Data folder to GCP Storage
-                                logging.info('Uploading extracted messages')
-                                self._upload_folder(self.BUCKET_NAME, self.DATA_FOLDER, self.DATA_FOLDER)
-
-                                # delete uploaded files
-                                self.delete_folder(self.DATA_FOLDER)
-
-                            # Update the config file
-                            user_server_channel[user][guild][channel]['last_processed'] = latest_message_processed
-                            user_server_channel[user][guild][channel]['status'] = "processed"
-                    except:
-                        logging.info("Skipping channel: {}".format(user_server_channel[user][guild][channel]['name']))
-        
-        # Write the updated config file
-        self._write_file('configs/user_server_channel_DO_NOT_EDIT.json', user_server_channel)
-
-        # Upload the updated config files to GCP Storage
-        logging.info('Uploading updated  configs')
-        self._upload_folder(self.BUCKET_NAME, 'configs/', 'configs/')
+        self._extract_messages_from_channels('processing')
     
 
     def extract_message_from_new_channels(self):
@@ -363,28 +346,16 @@ class DiscordChatRetrieverDataHub:
         2. Loop through every user in the user_server_channel config file
                 * Loop through every guild
                 * Loop through every channel and check if the status is 'new'
-                    * Create a new JSON object for the channel
-                    * Request the latest messages from the channel
-                    * Update the JSON object with the messages
-                    * Set the BEFORE param to the timestamp of the latest message processed
-                    * Also, save the latest message ID to store in the config file
-                    * Do the following until no more messages are found
-                        * Get the 'message' endpoint params and set the before param to the last message processed
-                        * Request the messages before the BEFORE param
-                        * Add the messages to the JSON object and update the BEFORE param
-                    * Reverse the messages in the JSON object so that the messages are in chronological order
+                    * Stream the whole history of the channel through the extraction pipeline 
+                    (see _extract_channel)
                     * Update the config file
                         * Set the status to 'processed'
-                        * Set the last_processed to the latest message processed
-                    * Write the JSON object to a file
+                        * Set the last_processed to the latest message crawled
         3. Write the updated config file
-        4. Upload the update file to GCP Storage
-        5. Upload the Data folder to GCP Storage
+        4. Sync the config folder to GCP Storage
 
         ------------------------------------
 
-        TODO: Upload the files to GCP Storage
-
         TODO: 
             * To avoid global time limit for the script
                 * Only process a single channel
@@ -395,140 +366,679 @@ class DiscordChatRetrieverDataHub:
         
         """
 
+        self._extract_messages_from_channels('new')
+
+
+    def _extract_messages_from_channels(self, status):
+        """ Extract the messages of every channel of the config file with the given status
+
+        Keyword Arguments:
+        * status: str -- 'processing' (crawl up to the last processed message) or 'new' (crawl the whole history)
+        """
 
         logging.info("Downloading configs")
 
-        # Download the config files from GCP Storage
-        # download_folder(BUCKET_NAME, 'configs/', 'configs/')
+        # Sync the config files from GCP Storage, this also records the generations the uploads of the
+        # updated configs and of the commit log are conditional on
+        self._sync_folder_down(self.BUCKET_NAME, 'configs/', 'configs/')
 
         # Read the config file
         user_token = self._read_config_as_json()
         user_server_channel = self._read_config_as_json('configs/user_server_channel_DO_NOT_EDIT.json')
 
+        # Read the commit log of the extractions interrupted by a crash
+        self.commit_log = self._read_commit_log()
+
+        # Apply the crawler settings, open the local message store, the filter pool and the media pool
+        self._load_crawler_settings()
+        self._open_message_store()
+        self._open_filter_pool()
+        self._open_media_pool()
+
         # Loop through every user in the user_server_channel config file
         for user in user_server_channel:
             # Loop through every guild
             for guild in user_server_channel[user]:
-                # Loop through every channel and check if the status is 'new'
+                # Loop through every channel and check the status
                 for channel in user_server_channel[user][guild]:
+                    channel_config = user_server_channel[user][guild][channel]
                     try:
-
-                        if user_server_channel[user][guild][channel]['status'] == 'new':
-                            logging.info("Extracting messages from channel (User: {}, Guild: {}, Channel: {})".format(
+                        if channel_config['status'] == status:
+                            logging.info('Extracting messages from channel (User: {}, Guild: {}, Channel: {})'.format(
                                 user, 
                                 guild, 
                                 channel))
-
-                            # Create a new JSON object for the channel
-                            messages_json = self._create_base_message_json(user, guild, channel, user_server_channel[user][guild][channel]['name'])
-                            
-                            print("Processing channel: {}".format(user_server_channel[user][guild][channel]['name']))
-
-                            # Request the latest messages from the channel
-                            messages = self._request_url_response(self.BASE_URL + self.urls['messages'].format(channel), 
-                                                            user_token[user]['token'], 
-                                                            {'limit': 1})
-                            
-                            # Update the JSON object with the messages if the message passes the regex filters
-                            if self._check_filters_on_message(messages[0]):
-                                messages_json['messages'] = messages
-                                if "attachments" in messages[0]:
-                                    for attachment in messages[0]["attachments"]:
-                                        if 'url' in attachment:
-                                            self._download_content(attachment['url'], self.DATA_FOLDER_MEDIA)
-                            else:
-                                messages_json['messages'] = []
-
-                            # Set the BEFORE param to the timestamp of the latest message processed
-                            last_message_processed = messages_json['messages'][0]['id']
-                            
-                            # Also, save the latest message ID to store in the config file
-                            latest_message_processed = messages_json['messages'][-1]['id']
-                            
-                            check = True
-                            while (check):
-                                # Get the 'message' endpoint params and set the before param to the last message processed
-                                params = self.url_params['messages'].copy()
-                                params['before'] = last_message_processed
-                                
-                                # Request the messages before the BEFORE param
-                                messages = self._request_url_response(self.BASE_URL + self.urls['messages'].format(channel), 
-                                                                user_token[user]['token'], 
-                                                                params)
-
-                                temporary_messages_holder = []
-                                for message in messages:
-                                    # Write the messages to the holder if the message passes the regex filters
-                                    if self._check_filters_on_message(message):
-                                        temporary_messages_holder.append(message)
-                                        if "attachments" in message:
-                                            for attachment in message["attachments"]:
-                                                if 'url' in attachment:
-                                                    self._download_content(attachment['url'], self.DATA_FOLDER_MEDIA)
-                                
-                                # Check if the messages list is empty, if it is, break both the loops
-                                if len(messages) == 0:
-                                    check = False
-                                    break
-
-                                # Update the BEFORE param to the last message processed
-                                last_message_processed = messages[-1]['id']
-
-                                # Update the JSON object with the messages
-                                messages_json['messages'] += temporary_messages_holder
-
-                                # Mini-batch: Write the JSON object to a file for every specific number of messages
-                                if len(messages_json['messages']) > self.NUM_MESSAGES_PER_FILE:
-
-                                    # Reverse the messages in the JSON object so that the messages are in chronological order
-                                    messages_json['messages'].reverse()
-
-                                    # Get current time string
-                                    timestr = datetime.now().strftime("%Y%m%d-%H%M%S%f")
-
-                                    # Write the JSON object to a file
-                                    self._write_file(self.DATA_FOLDER + '{}_{}.json'.format(channel, timestr), messages_json)
-
-                                    # Upload the Data folder to GCP Storage
-                                    logging.info('Uploading extracted messages')
-                                    self._upload_folder(self.BUCKET_NAME, self.DATA_FOLDER, self.DATA_FOLDER)
-
-                                    # delete uploaded files
-                                    self.delete_folder(self.DATA_FOLDER)
-
-                                    # Initialize messages in the JSON object
-                                    messages_json['messages'] = []
-
-                            # Upload the rest of files that were not processed by mini-batches
-                            if len(messages_json['messages']) > 0:
-                                # Reverse the messages in the JSON object so that the messages are in chronological order
-                                messages_json['messages'].reverse()
-
-                                # Get current time string
-                                timestr = datetime.now().strftime("%Y%m%d-%H%M%S%f")
-
-                                # Write the JSON object to a file
-                                self._write_file(self.DATA_FOLDER + '{}_{}.json'.format(channel, timestr), messages_json)
-
-                                # Upload the Data folder to GCP Storage
-                                logging.info('Uploading extracted messages')
-                                self._upload_folder(self.BUCKET_NAME, self.DATA_FOLDER, self.DATA_FOLDER)
-
-                                # delete uploaded files
-                                self.delete_folder(self.DATA_FOLDER)
-
-                            # Update the config file
-                            user_server_channel[user][guild][channel]['last_processed'] = latest_message_processed
-                            user_server_channel[user][guild][channel]['status'] = "processed"
-                    except:
-                        logging.info("Skipping channel: {}".format(user_server_channel[user][guild][channel]['name']))
+                            self.channel_report = self._new_channel_report(user, guild, channel, channel_config['name'], status)
+
+                            # Resume the extraction if it was interrupted after some chunks were committed, unless
+                            # the cursor was already advanced and only the removal of the log entry was lost
+                            commit_entry = self.commit_log.get(channel)
+                            if commit_entry is not None and commit_entry['latest_message_id'] == channel_config['last_processed']:
+                                commit_entry = None
+
+                            # New channels are crawled until the start of their history
+                            stop_after = channel_config['last_processed'] if status == 'processing' else None
+                            latest_message_processed = self._extract_channel(user, 
+                                                                            guild, 
+                                                                            channel, 
+                                                                            channel_config['name'], 
+                                                                            user_token[user]['token'], 
+                                                                            stop_after,
+                                                                            commit_entry)
+
+                            # Advance the cursor in the config file, then drop the channel from the commit log
+                            if latest_message_processed is not None:
+                                channel_config['last_processed'] = latest_message_processed
+                            channel_config['status'] = "processed"
+                            self.commit_log.pop(channel, None)
+                            self._write_file('configs/user_server_channel_DO_NOT_EDIT.json', user_server_channel)
+                            self._write_commit_log()
+                            self.channel_report['exit_reason'] = 'completed'
+                    except (Exception, SystemExit) as e:
+                        logging.info("Skipping channel: {} ({}: {})".format(channel_config['name'], type(e).__name__, e))
+
+                        # Keep the reason recorded before exiting, e.g. the status and URL of a failed request
+                        if self.channel_report is not None and self.channel_report['exit_reason'] is None:
+                            self.channel_report['exit_reason'] = '{}: {}'.format(type(e).__name__, e)
+
+                    if self.channel_report is not None:
+                        self._write_channel_report()
+
+        # Close the local message store, the filter pool and the media pool
+        self._close_message_store()
+        self._close_filter_pool()
+        self._close_media_pool()
+
+        for expression, count in self.page_filter.match_counts.items():
+            logging.info("Filter {} matched {} messages".format(expression, count))
 
         # Write the updated config file
         self._write_file('configs/user_server_channel_DO_NOT_EDIT.json', user_server_channel)
 
-        # Upload the updated config files to GCP Storage
+        # Sync the updated config files to GCP Storage
         logging.info('Uploading updated configs')
-        self._upload_folder(self.BUCKET_NAME, 'configs/', 'configs/')
+        self._sync_folder_up(self.BUCKET_NAME, 'configs/', 'configs/')
+
+
+    def _new_channel_report(self, user, guild, channel, channel_name, status):
+        """ Start the report of a channel, the extraction stages add their counts to it
+
+        Keyword Arguments:
+        * user: str -- User ID
+        * guild: str -- Guild ID
+        * channel: str -- Channel ID
+        * channel_name: str -- Channel Name
+        * status: str -- Status of the channel in the config file
+
+        -------------------------------
+
+        Return Values:
+        * Dictionary with:
+            user_id, guild_id, channel_id, channel_name, status,
+            requests -- Discord API requests,
+            pages -- Pages of messages received,
+            messages_seen, messages_kept -- Messages before and after the filters,
+            chunks, bytes_written -- Chunks committed and their size,
+            attachments_fetched, attachments_failed -- Attachments downloaded for the channel,
+            rate_limit_wait_sec -- Time spent waiting on 429 (and 202 search) responses,
+            wall_time_sec -- Duration of the extraction,
+            exit_reason -- 'completed', or the exception which stopped the extraction
+        """
+
+        report = {
+            'user_id': user,
+            'guild_id': guild,
+            'channel_id': channel,
+            'channel_name': channel_name,
+            'status': status,
+            'requests': 0,
+            'pages': 0,
+            'messages_seen': 0,
+            'messages_kept': 0,
+            'chunks': 0,
+            'bytes_written': 0,
+            'attachments_fetched': 0,
+            'attachments_failed': 0,
+            'rate_limit_wait_sec': 0,
+            'wall_time_sec': 0,
+            'exit_reason': None
+        }
+
+        # Baselines of the run wide counters
+        report['_started'] = time.monotonic()
+        if self.media_pool is not None:
+            report['_attachments_fetched'] = self.media_pool.downloaded_count
+            report['_attachments_failed'] = len(self.media_pool.failures)
+        return report
+
+
+    def _write_channel_report(self):
+        """ Complete the report of the current channel and append it to the run report (JSON Lines) """
+
+        report = self.channel_report
+        self.channel_report = None
+
+        # The attachments of the channel are only all accounted for once the media pool is idle
+        if self.media_pool is not None:
+            self.media_pool.wait()
+            report['attachments_fetched'] = self.media_pool.downloaded_count - report.pop('_attachments_fetched', 0)
+            report['attachments_failed'] = len(self.media_pool.failures) - report.pop('_attachments_failed', 0)
+        report['wall_time_sec'] = round(time.monotonic() - report.pop('_started'), 3)
+        report['rate_limit_wait_sec'] = round(report['rate_limit_wait_sec'], 3)
+
+        # The first report of the run replaces the report of the previous run
+        self._create_folder(self.CACHE_FOLDER)
+        with open(self.RUN_REPORT_FILE, 'a' if self.run_report_written else 'w', encoding = 'utf-8') as f:
+            f.write(json.dumps(report, separators = (',', ':')) + '\n')
+        self.run_report_written = True
+
+
+    def _extract_channel(self, user, guild, channel, channel_name, token, stop_after = None, commit_entry = None):
+        """ Stream the messages of a channel through the extraction pipeline
+
+        Keyword Arguments:
+        * user: str -- User ID
+        * guild: str -- Guild ID
+        * channel: str -- Channel ID
+        * channel_name: str -- Channel Name
+        * token: str -- Discord token of the user
+        * stop_after: str -- Snowflake of the last processed message, None to crawl the whole history
+        * commit_entry: dict -- Commit log entry of an interrupted extraction of the channel to resume
+
+        -------------------------------
+
+        Pipeline (every stage is a generator of pages, so at most one page is buffered between two stages):
+        1. _paginate_messages -- pages of messages newest first, until stop_after or the start of the channel
+        (_search_messages instead with search pushdown, pages of the search results only)
+        (_archive_raw_pages -- with raw_archive, every message is also written to the raw archive)
+        2. _filter_pages -- messages not passing the filters are dropped
+        3. _download_page_attachments -- the attachments of the remaining messages are downloaded
+        4. _sink_pages -- the messages are written to the chunk sink of the channel, which commits a chunk
+        every time it is full
+
+        Commit protocol: every chunk is uploaded and recorded in the manifests and the message store, then in 
+        the commit log (see _log_committed_chunk), 
+        and the cursor in the config file is only advanced once the channel is done (with raw_archive, the open 
+        raw chunk is committed before every chunk is recorded). An interrupted extraction
+        is resumed from the oldest committed message with the same data folder and stop point, so replayed 
+        chunks get the same object names and overwrite instead of duplicating.
+
+        -------------------------------
+
+        Return Values:
+        * Snowflake of the latest message crawled, None if the channel had no new message
+        """
+
+        print("Processing channel: {}".format(channel_name))
+
+        # The cursor of the extraction, recorded in the commit log with every chunk
+        if commit_entry is not None:
+            logging.info("Resuming extraction of channel {} before message {}".format(channel, commit_entry['resume_before']))
+            cursor = dict(commit_entry)
+        else:
+            cursor = {
+                'latest_message_id': None,
+                'stop_after': stop_after,
+                'resume_before': None,
+                'data_folder': self.DATA_FOLDER
+            }
+
+        # Downloads left pending by an interrupted channel belong to no chunk
+        self.pending_media = {}
+
+        # Create a new JSON object for the channel and the sink writing its chunks
+        messages_json = self._create_base_message_json(user, guild, channel, channel_name)
+        chunk_sink = self._create_chunk_sink(messages_json, cursor['data_folder'])
+        chunk_sink.cursor = cursor
+
+        if self.search_params is not None:
+            pages = self._search_messages(guild, channel, token, cursor['stop_after'], cursor)
+        else:
+            pages = self._paginate_messages(channel, token, cursor['stop_after'], cursor)
+        if self.raw_archive:
+            raw_sink = CHUNK_SINKS[self.raw_archive_format](self, self._raw_folder(cursor['data_folder']), messages_json)
+            raw_sink.commit = self._commit_raw_chunk
+            chunk_sink.raw_sink = raw_sink
+            pages = self._archive_raw_pages(pages, raw_sink)
+        pages = self._filter_pages(pages)
+        pages = self._download_page_attachments(pages)
+        self._sink_pages(pages, chunk_sink)
+
+        return cursor['latest_message_id']
+
+
+    def _paginate_messages(self, channel, token, stop_after = None, cursor = None):
+        """ Generator of the pages of messages of a channel, newest first
+
+        Keyword Arguments:
+        * channel: str -- Channel ID
+        * token: str -- Discord token
+        * stop_after: str -- Snowflake of the last processed message, older messages are not yielded 
+        (None to page until the start of the channel)
+        * cursor: dict -- Updated with the 'latest_message_id' crawled, paging starts before its 'resume_before'
+
+        -------------------------------
+
+        Yield Values:
+        * List of Discord message objects (newest first)
+        """
+
+        params = self.url_params['messages'].copy()
+        stop_after = None if stop_after is None else int(stop_after)
+        if cursor is not None and cursor['resume_before'] is not None:
+            params['before'] = cursor['resume_before']
+
+        while True:
+            # Request the messages before the BEFORE param
+            messages = self._request_url_response(self.BASE_URL + self.urls['messages'].format(channel), 
+                                                token, 
+                                                params)
+
+            if cursor is not None and cursor['latest_message_id'] is None and len(messages) > 0:
+                cursor['latest_message_id'] = messages[0]['id']
+
+            # Only keep the messages newer than the last processed message
+            page = messages
+            if stop_after is not None:
+                page = [message for message in messages if int(message['id']) > stop_after]
+
+            if len(page) > 0:
+                yield page
+
+            # Stop at the last processed message or at the start of the channel
+            if len(page) < len(messages) or len(messages) < params['limit']:
+                return
+
+            # Update the BEFORE param to the last message processed
+            params['before'] = messages[-1]['id']
+
+
+    def _search_messages(self, guild, channel, token, stop_after = None, cursor = None):
+        """ Generator of the pages of messages of a channel matching the search parameters, newest first
+
+        Keyword Arguments:
+        * guild: str -- Guild ID
+        * channel: str -- Channel ID
+        * token: str -- Discord token
+        * stop_after: str -- Snowflake of the last processed message, older messages are not searched
+        (None to search until the start of the channel)
+        * cursor: dict -- Updated with the 'latest_message_id' of the channel, searching starts before its 
+        'resume_before'
+
+        -------------------------------
+
+        Yield Values:
+        * List of Discord message objects (newest first)
+        """
+
+        # The cursor advances to the latest message of the channel even if it doesn't match the search
+        if cursor is not None and cursor['latest_message_id'] is None:
+            latest = self._request_url_response(self.BASE_URL + self.urls['messages'].format(channel), 
+                                                token, 
+                                                {'limit': 1})
+            if len(latest) > 0:
+                cursor['latest_message_id'] = latest[0]['id']
+
+        # Narrow the snowflake range (both bounds exclusive) to the part of the channel left to extract
+        params = dict(self.search_params)
+        params['channel_id'] = channel
+        if stop_after is not None and int(stop_after) > int(params.get('min_id', 0)):
+            params['min_id'] = stop_after
+        if cursor is not None and cursor['resume_before'] is not None:
+            if 'max_id' not in params or int(cursor['resume_before']) < int(params['max_id']):
+                params['max_id'] = cursor['resume_before']
+
+        while True:
+            results = self._request_url_response(self.BASE_URL + self.urls['search'].format(guild), token, params)
+
+            # Every result is a list of messages around the hit, keep only the hits, without the search marker
+            # so they are stored as the crawl would store them
+            groups = results.get('messages') or []
+            page = []
+            for group in groups:
+                hits = [message for message in group if message.get('hit')]
+                page.extend({key: value for key, value in message.items() if key != 'hit'}
+                            for message in (hits if len(hits) > 0 else group[ : 1]))
+            page.sort(key = lambda message: int(message['id']), reverse = True)
+
+            if len(page) > 0:
+                yield page
+
+            if len(groups) < self.SEARCH_PAGE_SIZE or len(page) == 0:
+                return
+
+            # Page by snowflake instead of offset, the search offset is capped
+            params['max_id'] = page[-1]['id']
+
+
+    def _archive_raw_pages(self, pages, raw_sink):
+        """ Pipeline stage writing the messages as crawled to the raw archive, the last raw chunk is committed 
+        once the pages are exhausted
+
+        Keyword Arguments:
+        * pages: iterable -- Pages of Discord message objects
+        * raw_sink: ChunkSink -- Sink of the raw archive of the channel
+        """
+
+        for page in pages:
+            for message in page:
+                raw_sink.write(MessageRecord.from_message(message, raw_sink.header['channel_id']))
+            yield page
+
+        self._commit_raw_chunk(raw_sink)
+
+
+    def _raw_folder(self, data_folder):
+        """ Raw archive folder of the chunks of a data folder: data/YYYY-MM-DD/ -> raw/YYYY-MM-DD/ """
+
+        return self.RAW_FOLDER.format(data_folder.rstrip('/').split('/')[-1])
+
+
+    def _commit_raw_chunk(self, raw_sink):
+        """ Finalize the current raw chunk and upload it, raw chunks are not recorded in the manifests
+
+        Keyword Arguments:
+        * raw_sink: ChunkSink -- Sink of the raw archive of the channel
+        """
+
+        chunk = raw_sink.close()
+        if chunk is None:
+            return
+
+        logging.info('Uploading raw messages')
+        self._upload_file(self.BUCKET_NAME, chunk['path'], chunk['path'])
+        os.remove(chunk['path'])
+
+
+    def _filter_pages(self, pages):
+        """ Pipeline stage dropping the messages which don't pass the filters, a page at a time
+
+        With the filter pool, up to filter_prefetch_pages pages per process are filtered in parallel while the
+        previous stage fetches the next pages. The pages are yielded in order either way.
+
+        Keyword Arguments:
+        * pages: iterable -- Pages of Discord message objects
+        """
+
+        pages = self._count_pages(pages)
+        if self.filter_executor is None:
+            for page in pages:
+                yield self._count_kept(self.page_filter.filter_page(page))
+            return
+
+        in_flight = deque()
+        max_in_flight = self.filter_workers * self.filter_prefetch_pages
+        try:
+            for page in pages:
+                in_flight.append(self.filter_executor.submit(filter_page_in_worker, page))
+                if len(in_flight) >= max_in_flight:
+                    yield self._count_kept(self._filtered_page(in_flight.popleft()))
+
+            while len(in_flight) > 0:
+                yield self._count_kept(self._filtered_page(in_flight.popleft()))
+        finally:
+            for future in in_flight:
+                future.cancel()
+
+
+    def _count_pages(self, pages):
+        """ Count the pages and the messages seen in the report of the channel
+
+        Keyword Arguments:
+        * pages: iterable -- Pages of Discord message objects
+        """
+
+        for page in pages:
+            if self.channel_report is not None:
+                self.channel_report['pages'] += 1
+                self.channel_report['messages_seen'] += len(page)
+            yield page
+
+
+    def _count_kept(self, page):
+        """ Count the messages of a filtered page in the report of the channel
+
+        Keyword Arguments:
+        * page: list -- Discord message objects passing the filters
+        """
+
+        if self.channel_report is not None:
+            self.channel_report['messages_kept'] += len(page)
+        return page
+
+
+    def _filtered_page(self, future):
+        """ Wait for a page filtered by the filter pool and merge the match counts of its process
+
+        Keyword Arguments:
+        * future: Future -- Result of filter_page_in_worker
+        """
+
+        page, match_counts = future.result()
+        self.page_filter.merge_match_counts(match_counts)
+        return page
+
+
+    def _open_filter_pool(self):
+        """ Start the filter pool if filter_workers is set, every process compiles the filters once """
+
+        if self.filter_workers > 0 and self.filter_executor is None:
+            # The processes are started at the first page, once the media pool threads run: spawn them, a 
+            # forked child could inherit a lock held by another thread (logging handlers) and deadlock
+            self.filter_executor = ProcessPoolExecutor(max_workers = self.filter_workers, 
+                                                        mp_context = multiprocessing.get_context('spawn'),
+                                                        initializer = init_filter_worker,
+                                                        initargs = (self.message_filter, self.regex_filter_expression))
+
+
+    def _close_filter_pool(self):
+        """ Stop the filter pool """
+
+        if self.filter_executor is not None:
+            self.filter_executor.shutdown()
+            self.filter_executor = None
+
+
+    def _download_page_attachments(self, pages):
+        """ Pipeline stage queuing the attachments of the messages on the media pool, the downloads run while the
+        next pages are crawled
+
+        Keyword Arguments:
+        * pages: iterable -- Pages of Discord message objects
+        """
+
+        for page in pages:
+            if self.download_attachments:
+                for message in page:
+                    for attachment in message.get('attachments') or []:
+                        if 'url' in attachment and self._attachment_is_eligible(attachment):
+                            done = self.media_pool.submit(attachment, 
+                                                            self.DATA_FOLDER_MEDIA, 
+                                                            message['id'], 
+                                                            message.get('channel_id'))
+                            self.pending_media.setdefault(message['id'], []).append(done)
+            yield page
+
+
+    def _attachment_is_eligible(self, attachment):
+        """ Decide from the metadata of an attachment (size, content_type) if it is downloaded, without any request
+
+        Keyword Arguments:
+        * attachment: dict -- Discord attachment object
+        """
+
+        size = attachment.get('size')
+        if self.download_attachments_MAX_SIZE is not None and size is not None and size > self.download_attachments_MAX_SIZE:
+            logging.info("File too large ({}): {}".format(size, attachment['url']))
+            return False
+
+        if self.download_attachments_content_types is not None:
+            content_type = (attachment.get('content_type') or '').split(';')[0].strip()
+            for allowed in self.download_attachments_content_types:
+                if content_type == allowed or (allowed.endswith('/*') and content_type.startswith(allowed[ : -1])):
+                    return True
+            logging.info("Content type not downloaded ({}): {}".format(content_type, attachment['url']))
+            return False
+
+        return True
+
+
+    def _open_media_pool(self):
+        """ Start the attachment download pool if attachments are downloaded """
+
+        if self.download_attachments and self.media_pool is None:
+            derivative_options = None
+            if self.media_derivatives:
+                derivative_options = {
+                    'format': self.media_derivative_format,
+                    'quality': self.media_derivative_quality,
+                    'thumbnail_size': self.media_thumbnail_size,
+                    'max_dimension': self.media_max_dimension,
+                    'replace_original_over': self.media_replace_original_over
+                }
+
+            if self.media_manifest_format not in MEDIA_MANIFESTS:
+                logging.error("Unknown media manifest format: {}".format(self.media_manifest_format))
+                self.upload_logs(self.LOG_FILE_NAME)
+                exit(1)
+
+            # Every run starts a new manifest, the manifest left by a crashed run is uploaded first: the 
+            # attachments it records are already stored
+            self._create_folder(self.CACHE_FOLDER)
+            for leftover_class in MEDIA_MANIFESTS.values():
+                leftover_path = self.MEDIA_MANIFEST_FILE.format(leftover_class.EXTENSION)
+                if os.path.exists(leftover_path):
+                    logging.warning("Uploading the media manifest of an interrupted run: {}".format(leftover_path))
+                    self._upload_media_manifest(leftover_path, 
+                                                leftover_class.EXTENSION, 
+                                                datetime.fromtimestamp(os.path.getmtime(leftover_path)),
+                                                interrupted = True)
+                    os.remove(leftover_path)
+
+            manifest_class = MEDIA_MANIFESTS[self.media_manifest_format]
+            manifest_path = self.MEDIA_MANIFEST_FILE.format(manifest_class.EXTENSION)
+
+            self.media_pool = MediaDownloadPool(self, 
+                                                self.media_workers, 
+                                                self.media_queue_size, 
+                                                self.media_requests_per_second,
+                                                manifest_class(manifest_path),
+                                                derivative_options,
+                                                self.media_derivative_workers)
+
+
+    def _close_media_pool(self):
+        """ Wait for the queued attachments, stop the download pool, log the failed downloads and upload the media
+        manifest
+        """
+
+        if self.media_pool is not None:
+            self.media_pool.close()
+            logging.info("Downloaded {} attachments ({} bytes), {} failed".format(
+                self.media_pool.downloaded_count,
+                self.media_pool.downloaded_bytes,
+                len(self.media_pool.failures)))
+            for failure in self.media_pool.failures:
+                logging.warning("Failed attachment: {}".format(failure))
+
+            # Upload the media manifest of the run
+            manifest = self.media_pool.manifest
+            if manifest.record_count > 0:
+                self._upload_media_manifest(manifest.path, manifest.EXTENSION, datetime.now())
+            if os.path.exists(manifest.path):
+                os.remove(manifest.path)
+            self.media_pool = None
+
+
+    def _upload_media_manifest(self, path, extension, written, interrupted = False):
+        """ Upload a media manifest to manifests/YYYY-MM-DD/media/HH-MM-SS[_interrupted]{extension}
+
+        Keyword Arguments:
+        * path: str -- Path of the manifest file
+        * extension: str -- Extension of the manifest format
+        * written: datetime -- Time the manifest was last written, names the object
+        * interrupted: bool -- Whether the manifest was left by an interrupted run
+        """
+
+        self._upload_file(self.BUCKET_NAME, 
+                            path, 
+                            self.MEDIA_MANIFEST_OBJECT.format(
+                                written.strftime('%Y-%m-%d'),
+                                written.strftime('%H-%M-%S') + ('_interrupted' if interrupted else ''),
+                                extension))
+
+
+    def _sink_pages(self, pages, chunk_sink):
+        """ Pipeline stage writing the messages to the chunk sink, the last chunk is committed at the end
+
+        Keyword Arguments:
+        * pages: iterable -- Pages of Discord message objects
+        * chunk_sink: ChunkSink -- Sink of the channel (see _create_chunk_sink)
+        """
+
+        for page in pages:
+            for message in page:
+                self._write_message(chunk_sink, message)
+
+        # Commit the rest of the messages that were not committed by the sink
+        self._commit_chunk(chunk_sink)
+
+
+    def _load_crawler_settings(self, path = None):
+        """ Apply the optional crawler settings file on top of the defaults set in __init__
+
+        The settings file (configs/crawler_settings.json) is synced with the other configs, it holds a JSON 
+        object whose keys are listed in SETTINGS, e.g.:
+            {"output_format": "jsonl", "message_projection": ["id", "content", "author.id"]}
+
+        Keyword Arguments:
+        * path: str -- Settings file to apply instead of SETTINGS_FILE
+        """
+
+        path = self.SETTINGS_FILE if path is None else path
+        if os.path.isfile(path):
+            settings = self._read_config_as_json(path)
+            for key, value in settings.items():
+                if key not in self.SETTINGS:
+                    logging.warning("Ignoring unknown crawler setting: {}".format(key))
+                    continue
+                logging.info("Crawler setting {}: {}".format(key, value))
+                setattr(self, key, value)
+
+        # Compile the message projection once per run
+        if self.message_projection is not None:
+            self.message_projector = compile_projection(self.message_projection)
+        else:
+            self.message_projector = None
+
+        # Compile the filters once per run
+        try:
+            self.page_filter = PageFilter(self.message_filter, self.regex_filter_expression)
+        except (ValueError, re.error) as e:
+            logging.error("Invalid message filter: {}".format(e))
+            self.upload_logs(self.LOG_FILE_NAME)
+            exit(1)
+        if self.message_filter is not None and self.regex_filter_expression:
+            logging.warning("Both message_filter and regex_filter_expression are set, only message_filter is applied")
+
+        # Translate the filter query into search parameters, the channels are crawled in full if it can't be
+        self.search_params = None
+        if self.search_pushdown and self.message_filter is not None:
+            self.search_params = search_params_for_query(self.message_filter)
+            if self.search_params is None:
+                logging.warning("The message filter can't be pushed down to the search, crawling every message")
+            else:
+                logging.info("Searching messages with: {}".format(self.search_params))
+
+        if self.raw_archive and self.raw_archive_format not in self.RAW_FORMATS:
+            logging.error("Unknown raw archive format: {}".format(self.raw_archive_format))
+            self.upload_logs(self.LOG_FILE_NAME)
+            exit(1)
+        if self.raw_archive and self.search_params is not None:
+            logging.warning("The raw archive only holds the search results with search pushdown")
+
+        # User table of the run, user ID -> (user object, encoded user)
+        self.user_table = LRUCache(maxsize = self.user_table_size) if self.normalize_users else None
 
 
     def _twitter_snowflake_to_datetime(self, snowflake):
@@ -583,10 +1093,12 @@ class DiscordChatRetrieverDataHub:
         """
 
         self.requests_per_second += 1
+        if self.channel_report is not None:
+            self.channel_report['requests'] += 1
 
         # Check if global rate limit is reached
         # If so, wait until the next second
-        while self.requests_per_second > self.GLOBAL_RATE_LIMIT_PER_SEC and time.time_ns() - start_time < 1e9:
+        while self.requests_per_second > self.GLOBAL_RATE_LIMIT_PER_SEC and time.time_ns() - self.start_time < 1e9:
             continue
 
         # If the next second has started, reset the counter
@@ -602,14 +1114,24 @@ class DiscordChatRetrieverDataHub:
         response = requests.get(url, headers = headers, params = params)
 
         # Check if somehow the global rate limit was exceeded, if so, wait until the retry-after time
-        while response.status_code == 429:
-            logging.error("Global Rate Limit for invalid requests exceeded")
-            logging.warning("[Pausing for {}s] | Requested URL: {}".format(
-                response.json()['retry_after'], 
-                url))
-            time.sleep(int(response.json()['retry_after']))
-            self.requests_per_second = 0
-            start_time = time.time_ns()
+        # The search endpoint answers 202 while the search index of the guild is not ready
+        while response.status_code in (202, 429):
+            if response.status_code == 202:
+                retry_after = response.json().get('retry_after') or self.SEARCH_INDEX_RETRY_SEC
+                logging.warning("[Pausing for {}s] | Search index not ready: {}".format(retry_after, url))
+            else:
+                retry_after = int(response.json()['retry_after'])
+                logging.error("Global Rate Limit for invalid requests exceeded")
+                logging.warning("[Pausing for {}s] | Requested URL: {}".format(
+                    response.json()['retry_after'], 
+                    url))
+            time.sleep(retry_after)
+            if self.channel_report is not None:
+                self.channel_report['rate_limit_wait_sec'] += retry_after
+                self.channel_report['requests'] += 1
+            if response.status_code == 429:
+                self.requests_per_second = 0
+                self.start_time = time.time_ns()
 
             # Request the URL with the given parameters and headers again
             response = requests.get(url, headers = headers, params = params)
@@ -617,33 +1139,122 @@ class DiscordChatRetrieverDataHub:
         # Check if the request was not successful, if so, log the error, upload the logs and exit
         if response.status_code != 200:
             logging.error('Error while requesting URL: {}'.format(response.json()))
+            if self.channel_report is not None:
+                self.channel_report['exit_reason'] = 'HTTP {}: {}'.format(response.status_code, url)
             self.upload_logs(self.LOG_FILE_NAME)
             exit(1)
 
         # Return the response
         return response.json()
 
-    def _write_file(self, path, json_data):
+    def _write_file(self, path, json_data, compression = None):
         """ Dump json data to a file
 
         Keyword Arguments:
         * path: str -- Path to the file to dump the data to
         * json_data: json object -- JSON data to dump to the file
+        * compression: str -- None to pretty print the JSON, 'gzip' or 'zstd' to stream compact JSON 
+        through the compressor
         """
 
         logging.info("Writing file: {}".format(path))
         file_route = path.split('/')
         self._create_folder('/'.join(file_route[ : -1]))
         try:
-            with open(path, 'w') as f:
-                json.dump(json_data, 
-                            f,
-                            indent=4, 
-                            separators=(',', ': '))
+            with self._open_output_file(path, compression) as f:
+                if compression is None:
+                    json.dump(json_data, 
+                                f,
+                                indent=4, 
+                                separators=(',', ': '))
+                else:
+                    json.dump(json_data, 
+                                f,
+                                separators=(',', ':'))
         except Exception as e:
             logging.error("Error while writing file: {}".format(e))
             self.upload_logs(self.LOG_FILE_NAME)
             exit(1)
+
+
+    def _open_output_file(self, path, compression = None):
+        """ Open a text file for writing, optionally through a streaming compressor
+
+        Keyword Arguments:
+        * path: str -- Path of the file to open
+        * compression: str -- None, 'gzip' or 'zstd'
+
+        --------------------------------
+
+        Return Values:
+        * A writable text file object, the compressed stream is finalized when it is closed
+        """
+
+        if compression is None:
+            return open(path, 'w')
+
+        if compression == 'gzip':
+            compression_level = 6 if self.output_compression_level is None else self.output_compression_level
+            return gzip.open(path, 'wt', compresslevel = compression_level, encoding = 'utf-8')
+
+        if compression == 'zstd':
+            if zstandard is None:
+                raise ValueError("zstd compression requires the zstandard package")
+            compression_level = 3 if self.output_compression_level is None else self.output_compression_level
+            compressor = zstandard.ZstdCompressor(level = compression_level)
+            return io.TextIOWrapper(compressor.stream_writer(open(path, 'wb')), encoding = 'utf-8')
+
+        raise ValueError("Unknown output compression: {}".format(compression))
+
+
+    def _read_chunk_file(self, path):
+        """ Read a chunk file written by a chunk sink, whatever its format and compression
+
+        Keyword Arguments:
+        * path: str -- Path of the chunk file (.json or .jsonl, optionally with .gz or .zst, or .dca)
+
+        --------------------------------
+
+        Return Values:
+        * The JSON object of the chunk (see _create_base_message_json), messages in chronological order
+        """
+
+        if path.endswith('.dca'):
+            return read_archive(path)
+
+        with self._open_input_file(path) as f:
+            if '.jsonl' not in os.path.basename(path):
+                return json.load(f)
+
+            # JSON Lines: a header record followed by one message per line
+            chunk = json.loads(f.readline())
+            chunk['messages'] = [json.loads(line) for line in f if line.strip()]
+            if chunk.pop('order', None) == 'newest_first':
+                chunk['messages'].reverse()
+            chunk.pop('record', None)
+            return chunk
+
+
+    def _open_input_file(self, path):
+        """ Open a text file for reading, decompressing it based on its extension
+
+        Keyword Arguments:
+        * path: str -- Path of the file to open
+
+        --------------------------------
+
+        Return Values:
+        * A readable text file object
+        """
+
+        extension = os.path.splitext(path)[1]
+        if extension == '.gz':
+            return gzip.open(path, 'rt', encoding = 'utf-8')
+        if extension == '.zst':
+            if zstandard is None:
+                raise ValueError("Reading zstd files requires the zstandard package")
+            return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(path, 'rb')), encoding = 'utf-8')
+        return open(path, 'r')
     
 
     def _create_folder(self, folder_name):
@@ -662,7 +1273,8 @@ class DiscordChatRetrieverDataHub:
         # Check if the folder exists and create it if it doesn't
         if not os.path.exists(folder_name):
             logging.info("Creating folder {}".format(folder_name))
-            os.makedirs(folder_name)
+            # Other threads (e.g. the media pool) may create it in the meantime
+            os.makedirs(folder_name, exist_ok = True)
     
 
     def _create_base_message_json(self, user_id, guild_id, channel_id, channel_name):
@@ -692,34 +1304,507 @@ class DiscordChatRetrieverDataHub:
             "messages": []
         }
 
-    def _download_content(self, url, path):
-        """ Download media from a url and save it to a file, only if the file size is less than 8MB
+
+    def _create_chunk_sink(self, messages_json, folder):
+        """ Create the sink writing the chunks of a channel in the configured output format
 
         Keyword Arguments:
-        * url: str -- URL of the media
-        * path: str -- Path to save the media to
+        * messages_json: dict -- JSON object of the channel (see _create_base_message_json)
+        * folder: str -- Data folder to write the chunks to
 
-        ----------------------------------
+        -------------------------------
 
-        TODO: Handle files larger than 8MB
+        Return Values:
+        * A chunk sink (see discord_chat_retriever_sinks)
         """
 
-        try:
-            file_route = url.split('/')
-            path += '/'.join(file_route[len(file_route) - 3:len(file_route) - 2])
-            file_name = '/' + url.split('/')[-1]
-            self._create_folder(path)
-            file_size = int(requests.head(url).headers['Content-Length'])
-            if self.download_attachments and file_size < self.download_attachments_MAX_SIZE:
-                with open(path + file_name, 'wb') as f:
-                    f.write(requests.get(url).content)
-                logging.info("Downloading file: {}".format(url))
-            else:
-                logging.info("File too large ({}): {}".format(file_size, url))
-        except Exception as e:
-            logging.error("Error while downloading file: {}".format(e))  
+        if self.output_format not in CHUNK_SINKS:
+            logging.error("Unknown output format: {}".format(self.output_format))
             self.upload_logs(self.LOG_FILE_NAME)
             exit(1)
+
+        return CHUNK_SINKS[self.output_format](self, folder, messages_json)
+
+
+    def _write_message(self, chunk_sink, message):
+        """ Project a message, convert it to a MessageRecord and write it to the chunk sink of its channel and 
+        to the local message store
+
+        Keyword Arguments:
+        * chunk_sink: ChunkSink -- Sink of the channel (see _create_chunk_sink)
+        * message: dict -- Discord message object
+        """
+
+        # Downloads of the attachments of the message, the chunk holding the message waits for them
+        media = self.pending_media.pop(message['id'], None)
+
+        # Trim the message to the configured fields before it is buffered
+        if self.message_projector is not None:
+            message = self.message_projector(message)
+
+        # Replace the embedded users with their IDs
+        users = None
+        if self.user_table is not None:
+            users = {}
+            message = self._normalize_users(message, users)
+
+        # Only the compact record of the message is buffered by the sinks
+        record = MessageRecord.from_message(message, chunk_sink.header['channel_id'])
+        chunk_sink.write(record, users, media)
+        if self.message_store is not None:
+            self.message_store.add(chunk_sink.header, record)
+
+
+    def _normalize_users(self, message, users):
+        """ Replace the user objects embedded in a message (author, mentions, and those of the referenced 
+        message) with their IDs
+
+        Keyword Arguments:
+        * message: dict -- Discord message object
+        * users: dict -- Collects the users of the message (user ID -> encoded user)
+
+        --------------------------------
+
+        Return Values:
+        * Copy of the message referencing the users by ID
+        """
+
+        message = dict(message)
+        if isinstance(message.get('author'), dict) and 'id' in message['author']:
+            message['author'] = self._intern_user(message['author'], users)
+        if message.get('mentions'):
+            message['mentions'] = [self._intern_user(user, users) if isinstance(user, dict) and 'id' in user else user
+                                    for user in message['mentions']]
+        if isinstance(message.get('referenced_message'), dict):
+            message['referenced_message'] = self._normalize_users(message['referenced_message'], users)
+        return message
+
+
+    def _intern_user(self, user, users):
+        """ Look up a user in the user table of the run, encoding it only if it is new or changed
+
+        Keyword Arguments:
+        * user: dict -- Discord user object
+        * users: dict -- Collects the users of the message (user ID -> encoded user)
+
+        --------------------------------
+
+        Return Values:
+        * ID of the user
+        """
+
+        user_id = user['id']
+        entry = self.user_table.get(user_id)
+        if entry is None or entry[0] != user:
+            entry = (user, json.dumps(user, separators = (',', ':')))
+            self.user_table[user_id] = entry
+        users[user_id] = entry[1]
+        return user_id
+
+
+    def _open_message_store(self):
+        """ Open the local SQLite message store if a path is configured """
+
+        if self.message_store_path is not None and self.message_store is None:
+            self.message_store = SQLiteMessageStore(self.message_store_path, self.message_store_batch_size)
+
+
+    def _close_message_store(self):
+        """ Write the pending messages and close the local SQLite message store """
+
+        if self.message_store is not None:
+            self.message_store.close()
+            self.message_store = None
+
+
+    def _chunk_is_full(self, chunk_sink):
+        """ Check if the current chunk of a sink reached the target message count or byte size
+
+        Keyword Arguments:
+        * chunk_sink: ChunkSink -- Sink of the channel (see _create_chunk_sink)
+        """
+
+        if self.NUM_MESSAGES_PER_FILE is not None and chunk_sink.message_count >= self.NUM_MESSAGES_PER_FILE:
+            return True
+        if self.MAX_BYTES_PER_FILE is not None and chunk_sink.byte_count >= self.MAX_BYTES_PER_FILE:
+            return True
+        return False
+
+
+    def _commit_chunk(self, chunk_sink):
+        """ Finalize the current chunk of a sink, upload it and record it in the manifests
+
+        Keyword Arguments:
+        * chunk_sink: ChunkSink -- Sink of the channel (see _create_chunk_sink)
+        """
+
+        # Finalize the chunk file
+        media = chunk_sink.media
+        chunk = chunk_sink.close()
+        if chunk is None:
+            return
+        byte_size = os.path.getsize(chunk['path'])
+        if self.channel_report is not None:
+            self.channel_report['chunks'] += 1
+            self.channel_report['bytes_written'] += byte_size
+
+        # Upload the chunk to GCP Storage
+        logging.info('Uploading extracted messages')
+        self._upload_file(self.BUCKET_NAME, chunk['path'], chunk['path'])
+        if 'users_path' in chunk:
+            self._upload_file(self.BUCKET_NAME, chunk['users_path'], chunk['users_path'])
+
+        # The media pool uploads the attachments, wait for those of the chunk before committing it (the later
+        # ones keep downloading while the next chunk is crawled), and keep their manifest records on disk so a 
+        # crash doesn't lose them
+        if self.media_pool is not None:
+            futures.wait(media)
+            if self.media_pool.manifest is not None:
+                self.media_pool.manifest.flush()
+
+        # The raw archive is ahead of the chunk, commit it first: a resumed extraction doesn't crawl the 
+        # messages newer than the chunk again, they must not be left in an open raw chunk
+        if chunk_sink.raw_sink is not None:
+            self._commit_raw_chunk(chunk_sink.raw_sink)
+
+        # Record the uploaded chunk in the per-channel manifest and the per-day index
+        entry = {
+            'object': chunk['path'],
+            'channel_id': chunk_sink.header['channel_id'],
+            'first_snowflake': chunk['first_snowflake'],
+            'last_snowflake': chunk['last_snowflake'],
+            'message_count': chunk['message_count'],
+            'byte_size': byte_size
+        }
+        if 'users_path' in chunk:
+            entry['users_object'] = chunk['users_path']
+        self._record_chunk_in_manifests(entry, chunk_sink.header['guild_id'])
+
+        # Keep the local message store in step with the uploaded chunks
+        if self.message_store is not None:
+            self.message_store.flush()
+
+        # Record the chunk in the commit log last: a resumed extraction doesn't replay the chunk once it is 
+        # logged, the manifests and the store (both idempotent) must already have it
+        self._log_committed_chunk(chunk_sink, chunk)
+
+        # Delete the uploaded chunk files only, the media pool may still be writing attachments of the later 
+        # messages to the media folder inside the data folder
+        os.remove(chunk['path'])
+        if 'users_path' in chunk:
+            os.remove(chunk['users_path'])
+
+
+    def _log_committed_chunk(self, chunk_sink, chunk):
+        """ Record an uploaded chunk in the commit log and sync the log to GCP Storage
+
+        Keyword Arguments:
+        * chunk_sink: ChunkSink -- Sink of the channel, its cursor is the commit log entry of the channel
+        * chunk: dict -- Finalized chunk (see ChunkSink.close)
+
+        --------------------------------
+
+        Commit log entry of a channel (configs/chunk_commit_log.json):
+        * latest_message_id -- Latest message of the extraction, the cursor value once the channel is done
+        * stop_after -- Last processed message when the extraction started
+        * resume_before -- Oldest message of the committed chunks, an interrupted extraction resumes before it
+        * data_folder -- Data folder of the chunks, reused on resume so the object names are the same
+        """
+
+        cursor = chunk_sink.cursor
+        if cursor['resume_before'] is None or int(chunk['first_snowflake']) < int(cursor['resume_before']):
+            cursor['resume_before'] = chunk['first_snowflake']
+
+        self.commit_log[chunk_sink.header['channel_id']] = dict(cursor)
+        self._write_commit_log()
+
+
+    def _read_commit_log(self):
+        """ Read the commit log (channel ID -> commit log entry, see _log_committed_chunk)
+
+        Return Values:
+        * Commit log as a dictionary, empty if there is none
+        """
+
+        if not os.path.isfile(self.COMMIT_LOG_FILE):
+            return {}
+        return self._read_config_as_json(self.COMMIT_LOG_FILE)
+
+
+    def _write_commit_log(self):
+        """ Write the commit log and sync the configs to GCP Storage """
+
+        self._write_file(self.COMMIT_LOG_FILE, self.commit_log)
+        self._sync_folder_up(self.BUCKET_NAME, 'configs/', 'configs/')
+
+
+    def _record_chunk_in_manifests(self, entry, guild):
+        """ Add a committed chunk to the channel manifest and the day index in GCP Storage
+
+        Keyword Arguments:
+        * entry: dict -- Manifest entry of the chunk (object, channel_id, first_snowflake, last_snowflake, 
+        message_count, byte_size)
+        * guild: str -- Guild ID the channel belongs to
+
+        --------------------------------
+
+        Layout:
+        * manifests/YYYY-MM-DD/{channel}.json -- Every chunk object of the channel uploaded that day
+        * manifests/YYYY-MM-DD/index.json -- Per channel summary (manifest, snowflake range, counts) of the day
+
+        Readers open the index, pick the channels they need and prune the chunk objects by snowflake range
+        without listing the data prefix.
+        """
+
+        channel = entry['channel_id']
+        manifest_folder = self.MANIFEST_FOLDER.format(entry['object'].split('/')[1])
+        channel_manifest_name = manifest_folder + '{}.json'.format(channel)
+
+        def add_to_channel_manifest(manifest):
+            if manifest is None:
+                manifest = {'channel_id': channel, 'guild_id': guild, 'objects': []}
+
+            # Replace the entry of an object that was uploaded again
+            manifest['objects'] = [o for o in manifest['objects'] if o['object'] != entry['object']]
+            manifest['objects'].append(entry)
+            manifest['objects'].sort(key = lambda o: int(o['first_snowflake']))
+            return manifest
+
+        channel_manifest = self._update_json_blob(channel_manifest_name, add_to_channel_manifest)
+        self._update_day_index(manifest_folder, channel_manifest_name, channel_manifest)
+
+
+    def _remove_chunks_from_manifests(self, manifest_folder, channel, object_names):
+        """ Remove chunk objects (e.g. after compaction) from a channel manifest and the day index
+
+        Keyword Arguments:
+        * manifest_folder: str -- Manifest folder of the day the chunks were uploaded (manifests/YYYY-MM-DD/)
+        * channel: str -- Channel ID the chunks belong to
+        * object_names: list -- Names of the chunk objects to remove
+        """
+
+        channel_manifest_name = manifest_folder + '{}.json'.format(channel)
+
+        def remove_from_channel_manifest(manifest):
+            if manifest is not None:
+                manifest['objects'] = [o for o in manifest['objects'] if o['object'] not in object_names]
+            return manifest
+
+        channel_manifest = self._update_json_blob(channel_manifest_name, remove_from_channel_manifest)
+        if channel_manifest is not None:
+            self._update_day_index(manifest_folder, channel_manifest_name, channel_manifest)
+
+
+    def _update_day_index(self, manifest_folder, channel_manifest_name, channel_manifest):
+        """ Refresh the summary of a channel in the day index from its manifest
+
+        Keyword Arguments:
+        * manifest_folder: str -- Manifest folder of the day (manifests/YYYY-MM-DD/)
+        * channel_manifest_name: str -- Name of the channel manifest blob
+        * channel_manifest: dict -- Current content of the channel manifest
+        """
+
+        channel = channel_manifest['channel_id']
+        objects = channel_manifest['objects']
+
+        def update_day_index(index):
+            if index is None:
+                index = {'date': manifest_folder.split('/')[-2], 'channels': {}}
+
+            if len(objects) == 0:
+                index['channels'].pop(channel, None)
+                return index
+
+            index['channels'][channel] = {
+                'guild_id': channel_manifest['guild_id'],
+                'manifest': channel_manifest_name,
+                'first_snowflake': min((o['first_snowflake'] for o in objects), key = int),
+                'last_snowflake': max((o['last_snowflake'] for o in objects), key = int),
+                'object_count': len(objects),
+                'message_count': sum(o['message_count'] for o in objects),
+                'byte_size': sum(o['byte_size'] for o in objects)
+            }
+            return index
+
+        self._update_json_blob(manifest_folder + 'index.json', update_day_index)
+
+
+    def _update_json_blob(self, blob_name, update):
+        """ Read-modify-write a JSON blob in GCP Storage with generation preconditions
+
+        Keyword Arguments:
+        * blob_name: str -- Name of the JSON blob to update
+        * update: function -- Receives the current JSON object (None if the blob doesn't exist) and returns
+        the updated one
+
+        --------------------------------
+
+        Return Values:
+        * The updated JSON object
+
+        --------------------------------
+
+        The last written generation is cached, so the blob is only read again when another writer changed it
+        """
+
+        storage_client = storage.Client()
+        bucket = storage_client.bucket(self.BUCKET_NAME)
+
+        for attempt in range(self.MANIFEST_UPDATE_RETRIES):
+
+            # Read the blob if it is not cached or the cached generation is stale
+            if blob_name not in self.manifest_cache:
+                blob = bucket.get_blob(blob_name)
+                if blob is None:
+                    self.manifest_cache[blob_name] = (0, None)
+                else:
+                    self.manifest_cache[blob_name] = (blob.generation, self._read_json_blob(blob))
+
+            generation, data = self.manifest_cache[blob_name]
+            data = update(data)
+
+            try:
+                generation = self._write_json_blob(blob_name, data, generation)
+            except exceptions.PreconditionFailed:
+                logging.warning("Blob {} changed concurrently, retrying update ({})".format(blob_name, attempt + 1))
+                self.manifest_cache.pop(blob_name, None)
+                continue
+
+            self.manifest_cache[blob_name] = (generation, data)
+            return data
+
+        logging.error("Could not update blob {} after {} attempts".format(blob_name, self.MANIFEST_UPDATE_RETRIES))
+        self.upload_logs(self.LOG_FILE_NAME)
+        exit(1)
+
+
+    def _read_json_blob(self, blob):
+        """ Download a JSON blob, pinned to the generation it was listed with
+
+        Keyword Arguments:
+        * blob: google.cloud.storage.Blob -- Blob to download (with its metadata loaded)
+
+        --------------------------------
+
+        Return Values:
+        * Content of the blob as a JSON object
+        """
+
+        return json.loads(blob.download_as_bytes(if_generation_match = blob.generation))
+
+
+    def _write_json_blob(self, blob_name, data, generation):
+        """ Upload a JSON object as a blob, only if the blob is still at the given generation
+
+        Keyword Arguments:
+        * blob_name: str -- Name of the blob to write
+        * data: json object -- Content of the blob
+        * generation: int -- Expected current generation of the blob, 0 if it must not exist yet
+
+        --------------------------------
+
+        Return Values:
+        * The generation of the written blob
+
+        --------------------------------
+
+        Raises google.api_core.exceptions.PreconditionFailed if the blob changed
+        """
+
+        storage_client = storage.Client()
+        bucket = storage_client.bucket(self.BUCKET_NAME)
+        blob = bucket.blob(blob_name)
+        blob.upload_from_string(json.dumps(data), 
+                                content_type = 'application/json', 
+                                if_generation_match = generation)
+        return blob.generation
+
+    def _download_content(self, attachment, path, acquire = None):
+        """ Download an attachment and save it to a file, streaming it in fixed size blocks
+
+        Keyword Arguments:
+        * attachment: dict -- Discord attachment object (url, and id, filename and size when available)
+        * path: str -- Media folder to save the attachment to, in {attachment id}/{file name}
+        * acquire: function -- Called before every request, e.g. to wait for the request budget of the CDN
+
+        ----------------------------------
+
+        The eligibility of the attachment is decided beforehand from its metadata (see _attachment_is_eligible),
+        the size of the attachment object is trusted, a HEAD request is only sent if it is missing. Memory use 
+        is bounded by MEDIA_BLOCK_SIZE, interrupted downloads are resumed with HTTP Range requests (see 
+        _stream_to_file).
+
+        ----------------------------------
+
+        Return Values:
+        * Path of the downloaded file. Raises an exception if the download failed.
+        """
+
+        url = attachment['url']
+        file_route = url.split('?')[0].split('/')
+        path += attachment.get('id') or file_route[-2]
+        file_name = '/' + (attachment.get('filename') or file_route[-1])
+        self._create_folder(path)
+
+        file_size = attachment.get('size')
+        if file_size is None:
+            if acquire is not None:
+                acquire()
+            file_size = int(requests.head(url).headers['Content-Length'])
+
+        logging.info("Downloading file ({}): {}".format(file_size, url))
+        self._stream_to_file(url, path + file_name, file_size, acquire)
+        return path + file_name
+
+
+    def _stream_to_file(self, url, destination, file_size, acquire = None):
+        """ Stream a URL to a file in fixed size blocks, resuming partial downloads with HTTP Range requests
+
+        Keyword Arguments:
+        * url: str -- URL to download
+        * destination: str -- Path of the downloaded file
+        * file_size: int -- Expected size of the file in bytes
+        * acquire: function -- Called before every request (see _download_content)
+
+        ----------------------------------
+
+        The partial file is kept in the cache folder (keyed by the URL without its query string, which
+        changes when Discord re-signs the URL), so a download interrupted by an error or by the end of the 
+        run is resumed from where it stopped. The file is moved to its destination once complete.
+        """
+
+        self._create_folder(self.MEDIA_PARTIAL_FOLDER)
+        partial_path = self.MEDIA_PARTIAL_FOLDER + hashlib.sha1(url.split('?')[0].encode('utf-8')).hexdigest()
+
+        for attempt in range(self.MEDIA_DOWNLOAD_RETRIES):
+            offset = os.path.getsize(partial_path) if os.path.exists(partial_path) else 0
+            if offset >= file_size:
+                break
+
+            # Only request the missing bytes of a partial download
+            headers = {'Range': 'bytes={}-'.format(offset)} if offset > 0 else {}
+            if acquire is not None:
+                acquire()
+            try:
+                with requests.get(url, headers = headers, stream = True, timeout = self.MEDIA_TIMEOUT) as response:
+                    response.raise_for_status()
+
+                    # A 200 to a range request means the server sent the whole file again
+                    mode = 'ab' if response.status_code == 206 else 'wb'
+                    with open(partial_path, mode) as f:
+                        for block in response.iter_content(chunk_size = self.MEDIA_BLOCK_SIZE):
+                            f.write(block)
+            except requests.exceptions.RequestException as e:
+                logging.warning("Download interrupted at {} bytes, resuming ({}): {}".format(
+                    os.path.getsize(partial_path) if os.path.exists(partial_path) else 0,
+                    attempt + 1,
+                    e))
+
+        downloaded_size = os.path.getsize(partial_path) if os.path.exists(partial_path) else 0
+        if downloaded_size != file_size:
+            raise IOError("Incomplete download of {} ({} of {} bytes)".format(url, downloaded_size, file_size))
+
+        os.replace(partial_path, destination)
     
 
     def delete_folder(self, folder_name):
@@ -757,6 +1842,24 @@ class DiscordChatRetrieverDataHub:
                         'discordMessageExtractor.log'))
 
 
+    def upload_run_report(self):
+        """ Upload the per channel report of the run next to the logs, the next channel report starts the report
+        of a new run (warm Cloud Function instances reuse the data hub)
+        """
+
+        if not self.run_report_written:
+            return
+
+        self._upload_file(self.BUCKET_NAME, 
+                    self.RUN_REPORT_FILE, 
+                    '{}/{}/{}'.format(
+                        'logs', 
+                        self.run_started.strftime("%Y-%m-%d"), 
+                        'run_report_{}.jsonl'.format(self.run_started.strftime("%H-%M-%S"))))
+        self.run_report_written = False
+        self.run_started = datetime.now()
+
+
     def _upload_file(self, bucket_name, source_file, destination_file):
         """ Upload a single file to GCP Storage
         
@@ -776,6 +1879,16 @@ class DiscordChatRetrieverDataHub:
         bucket = storage_client.bucket(bucket_name)
         blob = bucket.blob(destination_file)
 
+        # Compressed files are stored as plain compressed objects, without a Content-Encoding: GCP Storage would
+        # decompress them on download and the stored bytes would no longer match the local ones
+        extension = os.path.splitext(source_file)[1]
+        if extension in self.COMPRESSED_CONTENT_TYPES:
+            blob.content_type = self.COMPRESSED_CONTENT_TYPES[extension]
+
+        # Upload large files with a resumable upload in chunks of bounded size
+        if os.path.getsize(source_file) > self.UPLOAD_CHUNK_SIZE:
+            blob.chunk_size = self.UPLOAD_CHUNK_SIZE
+
         # Upload the file
         blob.upload_from_filename(source_file)
     
@@ -813,6 +1926,169 @@ class DiscordChatRetrieverDataHub:
             # blob.download_to_filename(destination + blob.name.split('/')[-1])
             logging.info(f"downloading  blob to {blob.name}")
             blob.download_to_filename(blob.name)
+
+
+    def _sync_folder_down(self, bucket_name, prefix, destination):
+        """ Sync a Folder from GCP Storage, downloading only the blobs that changed since the last sync
+
+        Keyword Arguments:
+        * bucket_name: str -- Name of the bucket to sync the folder from
+        * prefix: str -- Prefix of the folder to sync
+        * destination: str -- Destination to sync the folder to
+
+        --------------------------------
+
+        Every synced blob is recorded in the sync state file with its generation and MD5 hash. A blob
+        is downloaded again only if its generation changed or the local copy no longer matches the
+        recorded hash. Local copies of blobs deleted from the bucket are removed.
+        """
+
+        logging.info("Syncing folder from GCP Storage (Bucket: {}, Prefix: {}, Destination: {})".format(
+            bucket_name, 
+            prefix, 
+            destination))
+
+        sync_state = self._read_sync_state()
+
+        # Create the storage client
+        storage_client = storage.Client()
+        bucket = storage_client.bucket(bucket_name)
+
+        # Create the destination folder if it doesn't exist
+        self._create_folder(destination)
+
+        # Only list the blob metadata, the content is downloaded for changed blobs only
+        listed_blobs = set()
+        for blob in bucket.list_blobs(prefix = prefix):
+            if blob.name.endswith('/'):
+                continue
+            listed_blobs.add(blob.name)
+
+            local_path = destination + blob.name[len(prefix):]
+            cached = sync_state.get(blob.name)
+            if (cached is not None 
+                    and cached['generation'] == blob.generation 
+                    and os.path.isfile(local_path) 
+                    and self._md5_of_file(local_path) == cached['md5_hash']):
+                logging.info("Config up to date, skipping download: {}".format(blob.name))
+                continue
+
+            logging.info("Downloading changed blob {} (generation: {})".format(blob.name, blob.generation))
+            self._create_folder(os.path.dirname(local_path) or '.')
+            blob.download_to_filename(local_path, if_generation_match = blob.generation)
+            sync_state[blob.name] = {'generation': blob.generation, 'md5_hash': blob.md5_hash}
+
+        # Remove the local copies of blobs that were deleted from GCP Storage
+        for blob_name in list(sync_state):
+            if blob_name.startswith(prefix) and blob_name not in listed_blobs:
+                local_path = destination + blob_name[len(prefix):]
+                logging.info("Blob deleted from GCP Storage, removing local copy: {}".format(blob_name))
+                if os.path.isfile(local_path):
+                    os.remove(local_path)
+                del sync_state[blob_name]
+
+        self._write_sync_state(sync_state)
+
+
+    def _sync_folder_up(self, bucket_name, prefix, source):
+        """ Sync a Folder to GCP Storage, uploading only the files that changed since the last sync
+
+        Keyword Arguments:
+        * bucket_name: str -- Name of the bucket to sync the folder to
+        * prefix: str -- Prefix of the folder to sync
+        * source: str -- Source of the folder to sync
+
+        --------------------------------
+
+        Uploads are conditional on the generation recorded at the last sync, so a blob that was changed
+        in GCP Storage by someone else is never overwritten. Such conflicts are logged and skipped, the
+        next sync downloads the newer blob.
+        """
+
+        logging.info("Syncing folder to GCP Storage (Bucket: {}, Prefix: {}, Source: {})".format(
+            bucket_name, 
+            prefix, 
+            source))
+
+        sync_state = self._read_sync_state()
+
+        # Create the storage client
+        storage_client = storage.Client()
+        bucket = storage_client.bucket(bucket_name)
+
+        relative_paths = glob.glob(source + '**', recursive = True)
+        for relative_path in relative_paths:
+            if not os.path.isfile(relative_path):
+                continue
+
+            blob_name = prefix + relative_path.replace(source, '')
+            md5_hash = self._md5_of_file(relative_path)
+            cached = sync_state.get(blob_name)
+            if cached is not None and cached['md5_hash'] == md5_hash:
+                logging.info("Config unchanged, skipping upload: {}".format(blob_name))
+                continue
+
+            # Generation 0 means the blob must not exist yet
+            blob = bucket.blob(blob_name)
+            try:
+                blob.upload_from_filename(relative_path, 
+                                        if_generation_match = cached['generation'] if cached is not None else 0)
+            except exceptions.PreconditionFailed:
+                logging.error("Blob {} changed in GCP Storage since the last sync, skipping upload".format(blob_name))
+                continue
+
+            logging.info("Uploaded changed file {} (generation: {})".format(blob_name, blob.generation))
+            sync_state[blob_name] = {'generation': blob.generation, 'md5_hash': blob.md5_hash}
+
+        self._write_sync_state(sync_state)
+
+
+    def _read_sync_state(self):
+        """ Read the local sync state (blob name -> generation and MD5 hash)
+
+        Return Values:
+        * Sync state as a dictionary, empty if no sync happened yet
+        """
+
+        if not os.path.isfile(self.CONFIG_SYNC_STATE_FILE):
+            return {}
+
+        try:
+            with open(self.CONFIG_SYNC_STATE_FILE, 'r') as f:
+                return json.load(f)
+        except Exception as e:
+            # A broken sync state only costs a full download, so start from scratch
+            logging.warning("Ignoring unreadable sync state: {}".format(e))
+            return {}
+
+
+    def _write_sync_state(self, sync_state):
+        """ Write the local sync state
+
+        Keyword Arguments:
+        * sync_state: dict -- Blob name -> generation and MD5 hash
+        """
+
+        self._write_file(self.CONFIG_SYNC_STATE_FILE, sync_state)
+
+
+    def _md5_of_file(self, path):
+        """ Compute the MD5 hash of a file in the format used by GCP Storage (base64 encoded digest)
+
+        Keyword Arguments:
+        * path: str -- Path of the file to hash
+
+        --------------------------------
+
+        Return Values:
+        * Base64 encoded MD5 digest of the file
+        """
+
+        md5 = hashlib.md5()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(65536), b''):
+                md5.update(block)
+        return base64.b64encode(md5.digest()).decode('utf-8')
     
 
     def _upload_folder(self, bucket_name, prefix, source):
@@ -845,24 +2121,3 @@ class DiscordChatRetrieverDataHub:
         for relative_path in relative_paths:
             if os.path.isfile(relative_path):
                 self._upload_file(bucket_name, relative_path, prefix + relative_path.replace(source, ''))
-    
-
-    def _check_filters_on_message(self, message):
-        """ Check if message content passes all the regex filters
-
-        Keyword Arguments:
-        * message: str -- Message to check
-        """
-        
-        content = message['content']
-        if content is None or len(content) == 0:
-            return False
-
-        if len(self.regex_filter_expression) == 0:
-            return True
-        
-        for filter in self.regex_filter_expression:
-            if re.search(filter, content):
-                return True
-
-        return False
@@ -0,0 +1,495 @@
+from datetime import datetime, timezone
+
+import logging
+import re
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+DISCORD_EPOCH = 1420070400000
+
+# Characters giving a pattern a regex meaning, a pattern without them is a plain keyword
+REGEX_METACHARACTERS = set('.^$*+?{}[]\\|()')
+
+# Constructs that can't be combined with other patterns: backreferences and named groups (group numbers and
+# names change in the combined pattern), conditionals, and global inline flags
+STANDALONE_PATTERN = re.compile(r'\\[1-9]|\\g<|\(\?P[<=]|\(\?<[^=!]|\(\?\(|\(\?[aiLmsux]+\)')
+
+class FilterEngine:
+    """ Content filters compiled once per run from the regex_filter_expression setting
+
+    A message passes the filters when any of the patterns matches its content, like re.search() of each
+    pattern in turn, but every pattern is only looked at once:
+    * Plain keywords go into an Aho-Corasick automaton (pyahocorasick, optional) or, without it, into an
+    escaped alternation
+    * Regular expressions are combined into a single alternation with one named group per pattern
+    * Patterns which can't be combined (see STANDALONE_PATTERN) are compiled and searched on their own
+    """
+
+    def __init__(self, expressions):
+        """ Compile the filter patterns
+
+        Keyword Arguments:
+        * expressions: list -- Regular expressions or plain keywords, matched against the message content
+
+        Raises re.error if a pattern is invalid.
+        """
+
+        self.expressions = list(expressions)
+        self.automaton = None
+        self.combined = None
+        self.standalone = []
+
+        keywords = []
+        alternatives = []
+        for index, expression in enumerate(self.expressions):
+            if expression and not REGEX_METACHARACTERS.intersection(expression):
+                keywords.append((index, expression))
+            elif STANDALONE_PATTERN.search(expression):
+                self.standalone.append((index, re.compile(expression)))
+            else:
+                # Validate the pattern on its own first so that errors point to it
+                re.compile(expression)
+                alternatives.append('(?P<r{}>{})'.format(index, expression))
+
+        if keywords and ahocorasick is not None:
+            self.automaton = ahocorasick.Automaton()
+            for index, keyword in keywords:
+                # The first rule with a keyword reports the matches
+                if keyword not in self.automaton:
+                    self.automaton.add_word(keyword, index)
+            self.automaton.make_automaton()
+        else:
+            alternatives = ['(?P<r{}>{})'.format(index, re.escape(keyword)) for index, keyword in keywords] + alternatives
+
+        if alternatives:
+            self.combined = re.compile('|'.join(alternatives))
+
+        logging.info("Compiled {} content filters ({} keywords{}, {} combined, {} standalone)".format(
+            len(self.expressions),
+            len(keywords),
+            '' if self.automaton is not None or not keywords else ' without pyahocorasick',
+            len(alternatives) - (0 if self.automaton is not None else len(keywords)),
+            len(self.standalone)))
+
+
+    def match(self, content):
+        """ Find a filter matching a content
+
+        Keyword Arguments:
+        * content: str -- Content of a message
+
+        --------------------------------
+
+        Return Values:
+        * The expression of a matching filter, None if no filter matches
+        """
+
+        if self.automaton is not None:
+            for end, index in self.automaton.iter(content):
+                return self.expressions[index]
+
+        if self.combined is not None:
+            match = self.combined.search(content)
+            if match is not None:
+                return self.expressions[int(match.lastgroup[1 : ])]
+
+        for index, pattern in self.standalone:
+            if pattern.search(content):
+                return self.expressions[index]
+
+        return None
+
+
+class PageFilter:
+    """ Filters of a run applied to whole pages of messages: the filter query when there is one, the content 
+    filters otherwise (messages without content never pass the content filters)
+    """
+
+    def __init__(self, message_filter = None, regex_filter_expression = ()):
+        """ Compile the filters
+
+        Keyword Arguments:
+        * message_filter: dict -- Filter query (see compile_query), None to use the content filters
+        * regex_filter_expression: list -- Content filters (see FilterEngine), ignored if there is a query
+
+        Raises ValueError or re.error if a filter is invalid.
+        """
+
+        self.query = compile_query(message_filter) if message_filter is not None else None
+        self.content_filter = None
+        if self.query is None and regex_filter_expression:
+            self.content_filter = FilterEngine(regex_filter_expression)
+
+        # Number of messages each content filter matched
+        self.match_counts = {}
+
+
+    def check(self, message):
+        """ Check if a message passes the filters
+
+        Keyword Arguments:
+        * message: dict -- Discord message object
+        """
+
+        if self.query is not None:
+            return self.query(message)
+
+        content = message.get('content')
+        if content is None or len(content) == 0:
+            return False
+
+        if self.content_filter is None:
+            return True
+
+        expression = self.content_filter.match(content)
+        if expression is None:
+            return False
+
+        self.match_counts[expression] = self.match_counts.get(expression, 0) + 1
+        return True
+
+
+    def filter_page(self, page):
+        """ Keep the messages of a page passing the filters
+
+        Keyword Arguments:
+        * page: list -- Discord message objects
+
+        --------------------------------
+
+        Return Values:
+        * List of the messages passing the filters, in page order
+        """
+
+        check = self.check
+        return [message for message in page if check(message)]
+
+
+    def merge_match_counts(self, match_counts):
+        """ Add the match counts of another filter, e.g. of a worker process """
+
+        for expression, count in match_counts.items():
+            self.match_counts[expression] = self.match_counts.get(expression, 0) + count
+
+
+# Filters of a worker process of the filter pool, see init_filter_worker
+_worker_filter = None
+
+def init_filter_worker(message_filter, regex_filter_expression):
+    """ Initializer of the filter pool processes, compiles the filters once per process
+
+    Keyword Arguments:
+    * message_filter: dict -- Filter query (see compile_query)
+    * regex_filter_expression: list -- Content filters (see FilterEngine)
+    """
+
+    global _worker_filter
+    _worker_filter = PageFilter(message_filter, regex_filter_expression)
+
+
+def filter_page_in_worker(page):
+    """ Filter a page in a worker process of the filter pool
+
+    Keyword Arguments:
+    * page: list -- Discord message objects
+
+    --------------------------------
+
+    Return Values:
+    * Tuple of the messages passing the filters and the match counts of the content filters for the page
+    """
+
+    kept = _worker_filter.filter_page(page)
+    match_counts = _worker_filter.match_counts
+    _worker_filter.match_counts = {}
+    return kept, match_counts
+
+
+def compile_query(query):
+    """ Compile a message filter query into a predicate
+
+    A query is a JSON tree of predicates combined with {"and": [...]}, {"or": [...]} and {"not": query}.
+    A predicate is an object with a single key:
+    * {"author": ["<user ID>", ...]} -- Author is one of the users
+    * {"type": [0, 19]} -- Message type is one of the types
+    * {"has_attachment": true} -- Message has (true) or doesn't have (false) attachments
+    * {"mime": ["image/*", "application/pdf"]} -- An attachment has one of the MIME types ('type/*' for any subtype)
+    * {"mentions_user": ["<user ID>", ...]} -- Message mentions one of the users
+    * {"mentions_role": ["<role ID>", ...]} -- Message mentions one of the roles
+    * {"id": {"min": "<snowflake>", "max": "<snowflake>"}} -- Snowflake in the range, both ends optional and inclusive
+    * {"date": {"after": "2023-01-01", "before": "2023-02-01T12:00:00"}} -- Sent in the range (ISO 8601, UTC if no
+    offset), after is inclusive and before exclusive, both optional
+    * {"content": ["<regex>", ...]} -- Content matches one of the patterns (see FilterEngine)
+    An object with several predicate keys is the AND of them.
+
+    The children of every and/or are evaluated cheapest first, e.g. the snowflake ranges before the content
+    regexes.
+
+    Keyword Arguments:
+    * query: dict -- Query tree
+
+    --------------------------------
+
+    Return Values:
+    * Function taking a message object and returning whether it passes the query
+
+    Raises ValueError if the query is malformed, re.error if a content pattern is invalid.
+    """
+
+    cost, predicate = _compile_node(query)
+    return predicate
+
+
+def _compile_node(query):
+    """ Compile a query node into (cost, predicate)
+
+    Keyword Arguments:
+    * query: dict -- Query node
+    """
+
+    if not isinstance(query, dict) or len(query) == 0:
+        raise ValueError("Query nodes must be non empty objects: {}".format(query))
+
+    if len(query) > 1:
+        return _compile_node({'and': [{key: value} for key, value in query.items()]})
+
+    (key, value), = query.items()
+    if key in ('and', 'or'):
+        if not isinstance(value, list) or len(value) == 0:
+            raise ValueError("'{}' takes a non empty list of queries".format(key))
+        children = sorted((_compile_node(child) for child in value), key = lambda child: child[0])
+        predicates = tuple(predicate for cost, predicate in children)
+        cost = sum(cost for cost, predicate in children)
+        if key == 'and':
+            return cost, lambda message: all(predicate(message) for predicate in predicates)
+        return cost, lambda message: any(predicate(message) for predicate in predicates)
+
+    if key == 'not':
+        cost, predicate = _compile_node(value)
+        return cost, lambda message: not predicate(message)
+
+    if key not in PREDICATES:
+        raise ValueError("Unknown query predicate: {}".format(key))
+    cost, compile_predicate = PREDICATES[key]
+    return cost, compile_predicate(value)
+
+
+def _check_list(key, value, item_types):
+    """ Check that a predicate argument is a non empty list of values of the given types
+
+    Keyword Arguments:
+    * key: str -- Name of the predicate, for the error message
+    * value: any -- Argument of the predicate
+    * item_types: tuple -- Accepted types of the values
+
+    Raises ValueError if the argument is of another type, e.g. a single string instead of a list of strings.
+    """
+
+    if (not isinstance(value, list) or len(value) == 0 
+            or not all(isinstance(item, item_types) and not isinstance(item, bool) for item in value)):
+        raise ValueError("'{}' takes a non empty list of {}: {}".format(
+            key, 
+            ' or '.join(item_type.__name__ for item_type in item_types), 
+            value))
+
+
+def _check_bounds(key, value, bound_keys, bound_types):
+    """ Check that a range predicate argument is an object with only the given bounds
+
+    Keyword Arguments:
+    * key: str -- Name of the predicate, for the error message
+    * value: any -- Argument of the predicate
+    * bound_keys: tuple -- Accepted bound names
+    * bound_types: tuple -- Accepted types of the bounds (None is always accepted)
+
+    Raises ValueError if the argument is not such an object.
+    """
+
+    if not isinstance(value, dict) or not set(value).issubset(bound_keys):
+        raise ValueError("'{}' takes an object with the keys {}: {}".format(key, ', '.join(bound_keys), value))
+    for bound in value.values():
+        if bound is not None and (not isinstance(bound, bound_types) or isinstance(bound, bool)):
+            raise ValueError("Invalid '{}' bound: {}".format(key, bound))
+
+
+def _user_id(user):
+    """ ID of an embedded user object, or the user itself when users are normalized to IDs """
+
+    return user.get('id') if isinstance(user, dict) else user
+
+
+def _compile_author(user_ids):
+    _check_list('author', user_ids, (str, int))
+    user_ids = frozenset(str(user_id) for user_id in user_ids)
+    return lambda message: _user_id(message.get('author') or {}) in user_ids
+
+
+def _compile_type(types):
+    _check_list('type', types, (int,))
+    types = frozenset(types)
+    return lambda message: message.get('type') in types
+
+
+def _compile_has_attachment(expected):
+    if not isinstance(expected, bool):
+        raise ValueError("'has_attachment' takes true or false: {}".format(expected))
+    return lambda message: bool(message.get('attachments')) == expected
+
+
+def _compile_mime(mime_types):
+    _check_list('mime', mime_types, (str,))
+    exact = frozenset(mime for mime in mime_types if not mime.endswith('/*'))
+    prefixes = tuple(mime[ : -1] for mime in mime_types if mime.endswith('/*'))
+
+    def has_mime(message):
+        for attachment in message.get('attachments') or []:
+            # Drop the parameters, e.g. 'text/plain; charset=utf-8'
+            mime = (attachment.get('content_type') or '').split(';')[0].strip()
+            if mime in exact or (prefixes and mime.startswith(prefixes)):
+                return True
+        return False
+
+    return has_mime
+
+
+def _compile_mentions_user(user_ids):
+    _check_list('mentions_user', user_ids, (str, int))
+    user_ids = frozenset(str(user_id) for user_id in user_ids)
+    return lambda message: any(_user_id(user) in user_ids for user in message.get('mentions') or [])
+
+
+def _compile_mentions_role(role_ids):
+    _check_list('mentions_role', role_ids, (str, int))
+    role_ids = frozenset(str(role_id) for role_id in role_ids)
+    return lambda message: any(role in role_ids for role in message.get('mention_roles') or [])
+
+
+def _compile_snowflake_range(low, high):
+    """ Predicate on the snowflake of the message, low and high are inclusive, None for no bound """
+
+    if low is None and high is None:
+        return lambda message: True
+    if high is None:
+        return lambda message: int(message['id']) >= low
+    if low is None:
+        return lambda message: int(message['id']) <= high
+    return lambda message: low <= int(message['id']) <= high
+
+
+def _compile_id(bounds):
+    _check_bounds('id', bounds, ('min', 'max'), (str, int))
+    low = bounds.get('min')
+    high = bounds.get('max')
+    return _compile_snowflake_range(None if low is None else int(low), None if high is None else int(high))
+
+
+def _compile_date(bounds):
+    _check_bounds('date', bounds, ('after', 'before'), (str,))
+    after = bounds.get('after')
+    before = bounds.get('before')
+    return _compile_snowflake_range(None if after is None else _date_to_snowflake(after),
+                                    None if before is None else _date_to_snowflake(before) - 1)
+
+
+def _date_to_snowflake(date):
+    """ Smallest snowflake of an ISO 8601 date, UTC if it has no offset """
+
+    moment = datetime.fromisoformat(date)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo = timezone.utc)
+    return max(int(moment.timestamp() * 1000) - DISCORD_EPOCH, 0) << 22
+
+
+def _compile_content(expressions):
+    if isinstance(expressions, str):
+        expressions = [expressions]
+    _check_list('content', expressions, (str,))
+    engine = FilterEngine(expressions)
+    return lambda message: engine.match(message.get('content') or '') is not None
+
+
+# Query predicates: name -> (relative evaluation cost, compile function)
+PREDICATES = {
+    'id': (1, _compile_id),
+    'date': (1, _compile_date),
+    'type': (1, _compile_type),
+    'has_attachment': (1, _compile_has_attachment),
+    'author': (2, _compile_author),
+    'mentions_user': (3, _compile_mentions_user),
+    'mentions_role': (3, _compile_mentions_role),
+    'mime': (4, _compile_mime),
+    'content': (10, _compile_content)
+}
+
+
+def search_params_for_query(query):
+    """ Translate a filter query into the parameters of the guild message search endpoint
+
+    Only a conjunction of content (a single plain keyword), author, has_attachment (true), mentions_user (a 
+    single user), id and date predicates can be pushed down. The search matches whole words, the results are still checked
+    with the compiled query.
+
+    Keyword Arguments:
+    * query: dict -- Query tree (see compile_query)
+
+    --------------------------------
+
+    Return Values:
+    * Dictionary of search parameters (min_id and max_id exclusive), None if the query can't be pushed down
+    """
+
+    if not isinstance(query, dict) or len(query) == 0:
+        return None
+
+    predicates = [{key: value} for key, value in query.items()]
+    if len(query) == 1 and 'and' in query:
+        predicates = query['and']
+
+    params = {}
+    min_id = None
+    max_id = None
+    for predicate in predicates:
+        if not isinstance(predicate, dict) or len(predicate) != 1:
+            return None
+        (key, value), = predicate.items()
+
+        if key == 'content':
+            expressions = [value] if isinstance(value, str) else value
+            if 'content' in params or len(expressions) != 1 or REGEX_METACHARACTERS.intersection(expressions[0]):
+                return None
+            params['content'] = expressions[0]
+        elif key == 'author':
+            params.setdefault('author_id', []).extend(str(user_id) for user_id in value)
+        elif key == 'mentions_user' and len(value) == 1:
+            # Several mentions in a search must all be present, only a single user is a match
+            params['mentions'] = str(value[0])
+        elif key == 'has_attachment' and value is True:
+            params['has'] = 'file'
+        elif key in ('id', 'date'):
+            if key == 'id':
+                low = None if value.get('min') is None else int(value['min']) - 1
+                high = None if value.get('max') is None else int(value['max']) + 1
+            else:
+                low = None if value.get('after') is None else _date_to_snowflake(value['after']) - 1
+                high = None if value.get('before') is None else _date_to_snowflake(value['before'])
+            if low is not None:
+                min_id = low if min_id is None else max(min_id, low)
+            if high is not None:
+                max_id = high if max_id is None else min(max_id, high)
+        else:
+            return None
+
+    # Several author or mention predicates in one conjunction can't be expressed as a single search
+    if sum(1 for predicate in predicates if 'author' in predicate) > 1:
+        return None
+    if sum(1 for predicate in predicates if 'mentions_user' in predicate) > 1:
+        return None
+
+    if min_id is not None:
+        params['min_id'] = str(max(min_id, 0))
+    if max_id is not None:
+        params['max_id'] = str(max_id)
+    return params
@@ -1,5 +1,7 @@
 from datetime import datetime
+from discord_chat_retriever_compactor import DiscordChatRetrieverCompactor
 from discord_chat_retriever_data_hub import *
+from discord_chat_retriever_reprocessor import DiscordChatRetrieverReprocessor
 from google.cloud import storage
 
 import argparse
@@ -54,8 +56,9 @@ def http_entry(request):
     discord_chat_retriever_data_hub.update_configs()
     discord_chat_retriever_data_hub.extract_message_from_explored_channels()
     discord_chat_retriever_data_hub.extract_message_from_new_channels()
+    discord_chat_retriever_data_hub.upload_run_report()
+    # The configs folder is kept so that warm instances only sync the configs that changed
     discord_chat_retriever_data_hub.delete_folder('data/')
-    discord_chat_retriever_data_hub.delete_folder('configs/')
     return "Request Complete."
 
 
@@ -70,6 +73,10 @@ def create_cmd_parser():
 
     # Add the arguments
     parser.add_argument('--mode', type = str, default = 'help', help = 'Mode to run the program in')
+    parser.add_argument('--dataset', 
+                        type = str, 
+                        default = datetime.now().strftime('%Y-%m-%d_%H-%M-%S'), 
+                        help = 'Name of the derived dataset written by the reprocess mode')
 
     return parser
 
@@ -106,6 +113,12 @@ if __name__ == "__main__":
         discord_chat_retriever_data_hub.update_configs()
         discord_chat_retriever_data_hub.extract_message_from_explored_channels()
         discord_chat_retriever_data_hub.extract_message_from_new_channels()
+    elif args.mode == 'compact':
+        logging.info("Running in compact mode")
+        DiscordChatRetrieverCompactor(discord_chat_retriever_data_hub).compact()
+    elif args.mode == 'reprocess':
+        logging.info("Running in reprocess mode")
+        DiscordChatRetrieverReprocessor(discord_chat_retriever_data_hub, args.dataset).reprocess()
     else:
         print("Invalid mode")
         upload_log_file = False
@@ -115,7 +128,8 @@ if __name__ == "__main__":
         discord_chat_retriever_data_hub.upload_logs(LOG_FILE_NAME)
         # upload log file for the data hub 
         discord_chat_retriever_data_hub.upload_logs(discord_chat_retriever_data_hub.LOG_FILE_NAME)
+        # upload the per channel report of the run
+        discord_chat_retriever_data_hub.upload_run_report()
 
-    # Deleting the data folder and the configs folder after the script is done
+    # Deleting the data folder after the script is done, the configs folder is kept as a sync cache
     discord_chat_retriever_data_hub.delete_folder('data/')
-    discord_chat_retriever_data_hub.delete_folder('configs/')
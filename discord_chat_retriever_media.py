@@ -0,0 +1,438 @@
+from concurrent.futures import Future, ProcessPoolExecutor
+
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Attachments the derivative stage works on
+IMAGE_CONTENT_TYPES = ('image/jpeg', 'image/png', 'image/webp', 'image/gif', 'image/bmp')
+
+# Format of the derivatives -> (Pillow format, file extension)
+DERIVATIVE_FORMATS = {'webp': ('WEBP', '.webp'), 'jpeg': ('JPEG', '.jpg')}
+
+class RequestBudget:
+    """ Spaces the requests of several threads to at most requests_per_second """
+
+    def __init__(self, requests_per_second):
+        """ Keyword Arguments:
+        * requests_per_second: float -- Request budget, None for no limit
+        """
+
+        self.interval = 0 if not requests_per_second else 1 / requests_per_second
+        self.next_time = time.monotonic()
+        self.lock = threading.Lock()
+
+
+    def acquire(self):
+        """ Wait for the next request slot """
+
+        if self.interval == 0:
+            return
+
+        with self.lock:
+            now = time.monotonic()
+            wait = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+
+        if wait > 0:
+            time.sleep(wait)
+
+
+class JsonLinesMediaManifest:
+    """ Media manifest written as JSON Lines, one record per stored attachment, shared by the download threads """
+
+    EXTENSION = '.jsonl'
+
+    def __init__(self, path, batch_size = None):
+        """ Keyword Arguments:
+        * path: str -- Path of the manifest file, created on the first record
+        * batch_size: int -- Unused, every record is written when it is added
+        """
+
+        self.path = path
+        self.file = None
+        self.record_count = 0
+        self.lock = threading.Lock()
+
+
+    def add(self, record):
+        """ Append a record to the manifest
+
+        Keyword Arguments:
+        * record: dict -- Attachment record (see MediaDownloadPool._download)
+        """
+
+        line = json.dumps(record, separators = (',', ':')) + '\n'
+        with self.lock:
+            if self.file is None:
+                self.file = open(self.path, 'w', encoding = 'utf-8')
+            self.file.write(line)
+            self.record_count += 1
+
+
+    def flush(self):
+        """ Write the buffered records to the manifest file """
+
+        with self.lock:
+            if self.file is not None:
+                self.file.flush()
+
+
+    def close(self):
+        """ Close the manifest file """
+
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+class SQLiteMediaManifest:
+    """ Media manifest written to a SQLite database keyed by attachment ID, shared by the download threads
+
+    Records are inserted in batched transactions, a re-downloaded attachment replaces its row. The message_id 
+    and sha256 indexes serve the joins with the messages and the duplicate lookups.
+    """
+
+    EXTENSION = '.sqlite3'
+    COLUMNS = ('attachment_id', 'message_id', 'channel_id', 'sha256', 'byte_size', 'content_type', 'filename', 
+                'object', 'width', 'height', 'thumbnail', 'transcode')
+
+    def __init__(self, path, batch_size = 1000):
+        """ Open (and create if needed) the media manifest
+
+        Keyword Arguments:
+        * path: str -- Path of the SQLite database
+        * batch_size: int -- Number of records inserted per transaction
+        """
+
+        logging.info("Opening media manifest: {}".format(path))
+        self.path = path
+        self.batch_size = batch_size
+        self.batch = []
+        self.record_count = 0
+        self.lock = threading.Lock()
+
+        # The connection is shared by the download threads, the lock serializes its use
+        self.connection = sqlite3.connect(path, check_same_thread = False)
+        with self.connection:
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS media (
+                    attachment_id INTEGER PRIMARY KEY,
+                    message_id INTEGER,
+                    channel_id INTEGER,
+                    sha256 TEXT NOT NULL,
+                    byte_size INTEGER NOT NULL,
+                    content_type TEXT,
+                    filename TEXT,
+                    object TEXT,
+                    width INTEGER,
+                    height INTEGER,
+                    thumbnail TEXT,
+                    transcode TEXT
+                )""")
+            self.connection.execute('CREATE INDEX IF NOT EXISTS media_message_id ON media (message_id)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS media_sha256 ON media (sha256)')
+
+
+    def add(self, record):
+        """ Queue a record for insertion, the batch is written once it is full
+
+        Keyword Arguments:
+        * record: dict -- Attachment record (see MediaDownloadPool._download)
+        """
+
+        row = tuple(record.get(column) for column in self.COLUMNS)
+        with self.lock:
+            self.batch.append(row)
+            self.record_count += 1
+            if len(self.batch) >= self.batch_size:
+                self._flush()
+
+
+    def flush(self):
+        """ Insert the queued records without waiting for a full batch """
+
+        with self.lock:
+            self._flush()
+
+
+    def close(self):
+        """ Write the remaining records and close the database """
+
+        with self.lock:
+            self._flush()
+            self.connection.close()
+
+
+    def _flush(self):
+        """ Upsert the queued records in a single transaction, the lock must be held """
+
+        if len(self.batch) == 0:
+            return
+
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO media ({}) VALUES ({})".format(
+                ', '.join(self.COLUMNS),
+                ', '.join('?' for _ in self.COLUMNS)), self.batch)
+        self.batch = []
+
+
+# Media manifest class per format
+MEDIA_MANIFESTS = {
+    'jsonl': JsonLinesMediaManifest,
+    'sqlite': SQLiteMediaManifest
+}
+
+
+class MediaDownloadPool:
+    """ Downloads the attachments in worker threads while the messages are crawled
+
+    The attachments are queued by the extraction (the queue is bounded, so a slow CDN only holds up the
+    extraction once the queue is full) and downloaded by the workers within their own request budget: the CDN
+    is not subject to the rate limits of the Discord API. Every downloaded file is uploaded to the same object
+    name in GCP Storage and removed locally. A failed download is recorded in failures and doesn't stop the
+    extraction.
+    """
+
+    def __init__(self, data_hub, workers, queue_size, requests_per_second, manifest = None, derivative_options = None,
+                    derivative_workers = None):
+        """ Start the workers
+
+        Keyword Arguments:
+        * data_hub: DiscordChatRetrieverDataHub -- Data hub downloading and uploading the files
+        * workers: int -- Number of download threads
+        * queue_size: int -- Number of attachments waiting for a worker before submit() blocks
+        * requests_per_second: float -- Request budget of the workers on the CDN, None for no limit
+        * manifest: JsonLinesMediaManifest or SQLiteMediaManifest -- Receives a record per stored attachment, None
+        for no manifest
+        * derivative_options: dict -- Options of the image derivatives (see create_derivatives), None to store
+        the originals only
+        * derivative_workers: int -- Processes creating the derivatives, None for one per core
+        """
+
+        self.data_hub = data_hub
+        self.manifest = manifest
+        self.derivative_options = derivative_options
+        self.derivative_executor = None
+        if derivative_options is not None:
+            if Image is None:
+                logging.error("Image derivatives require Pillow, storing the originals only")
+                self.derivative_options = None
+            else:
+                # The processes are started from the download threads: spawn them, a forked child could inherit
+                # a lock held by another thread (logging handlers) and deadlock
+                self.derivative_executor = ProcessPoolExecutor(max_workers = derivative_workers, 
+                                                                mp_context = multiprocessing.get_context('spawn'))
+        self.queue = queue.Queue(maxsize = queue_size)
+        self.budget = RequestBudget(requests_per_second)
+        self.lock = threading.Lock()
+
+        # Statistics of the run
+        self.downloaded_count = 0
+        self.downloaded_bytes = 0
+        self.failures = []
+
+        self.threads = [threading.Thread(target = self._work, daemon = True) for _ in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+
+    def submit(self, attachment, folder, message_id = None, channel_id = None):
+        """ Queue an attachment, waits while the queue is full
+
+        Keyword Arguments:
+        * attachment: dict -- Discord attachment object
+        * folder: str -- Media folder to download the file to
+        * message_id: str -- Message of the attachment
+        * channel_id: str -- Channel of the message
+
+        --------------------------------
+
+        Return Values:
+        * Future done once the attachment is stored or its failure recorded
+        """
+
+        done = Future()
+        self.queue.put((attachment, folder, message_id, channel_id, done))
+        return done
+
+
+    def wait(self):
+        """ Wait until every queued attachment is downloaded or failed """
+
+        self.queue.join()
+
+
+    def close(self):
+        """ Wait for the queued attachments and stop the workers """
+
+        self.wait()
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+        if self.derivative_executor is not None:
+            self.derivative_executor.shutdown()
+        if self.manifest is not None:
+            self.manifest.close()
+
+
+    def _work(self):
+        """ Worker loop: download, upload and remove the queued attachments until close() """
+
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                self._download(*item[ : -1])
+            finally:
+                if item is not None:
+                    item[-1].set_result(None)
+                self.queue.task_done()
+
+
+    def _download(self, attachment, folder, message_id, channel_id):
+        """ Download an attachment, create its derivatives and upload them, recording the failure if it can't be
+
+        Keyword Arguments:
+        * attachment: dict -- Discord attachment object
+        * folder: str -- Media folder to download the file to
+        * message_id: str -- Message of the attachment
+        * channel_id: str -- Channel of the message
+
+        --------------------------------
+
+        The derivatives are created in the process pool, only the thread of the attachment waits for them. The
+        original is replaced by its transcode when it is larger than derivative_options['replace_original_over']
+        bytes and the transcode is smaller.
+        """
+
+        try:
+            path = self.data_hub._download_content(attachment, folder, self.budget.acquire)
+            byte_size = os.path.getsize(path)
+            content_type = (attachment.get('content_type') or '').split(';')[0].strip()
+            record = {
+                'attachment_id': attachment.get('id'),
+                'message_id': message_id,
+                'channel_id': channel_id,
+                'sha256': _sha256_of_file(path),
+                'byte_size': byte_size,
+                'content_type': content_type or None,
+                'filename': attachment.get('filename'),
+                'object': path
+            }
+
+            uploads = [path]
+            derivatives = None
+            if self.derivative_executor is not None and content_type in IMAGE_CONTENT_TYPES:
+                # An image Pillow can't decode is still stored, as the original only
+                try:
+                    derivatives = self.derivative_executor.submit(create_derivatives, path, self.derivative_options).result()
+                except Exception as e:
+                    logging.warning("Error while creating the derivatives of {}, storing the original only: {}".format(
+                        attachment.get('url'), 
+                        e))
+
+            if derivatives is not None:
+                record.update(derivatives)
+                uploads += [derivatives['thumbnail'], derivatives['transcode']]
+
+                replace_over = self.derivative_options.get('replace_original_over')
+                if replace_over is not None and byte_size > replace_over and derivatives['transcode_byte_size'] < byte_size:
+                    uploads.remove(path)
+                    os.remove(path)
+                    record['object'] = None
+
+            for upload in uploads:
+                self.data_hub._upload_file(self.data_hub.BUCKET_NAME, upload, upload)
+                os.remove(upload)
+
+            if self.manifest is not None:
+                self.manifest.add(record)
+
+            with self.lock:
+                self.downloaded_count += 1
+                self.downloaded_bytes += byte_size
+        except Exception as e:
+            logging.error("Error while downloading file {}: {}".format(attachment.get('url'), e))
+            with self.lock:
+                self.failures.append({
+                    'attachment_id': attachment.get('id'),
+                    'message_id': message_id,
+                    'url': attachment.get('url'),
+                    'error': str(e)
+                })
+
+
+def _sha256_of_file(path):
+    """ Hex SHA-256 digest of a file, read in blocks """
+
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1048576), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def create_derivatives(path, options):
+    """ Create the thumbnail and the transcode of an image next to it, runs in the derivative process pool
+
+    Keyword Arguments:
+    * path: str -- Path of the image
+    * options: dict -- 'format' (see DERIVATIVE_FORMATS), 'quality', 'thumbnail_size' (max width/height of 
+    the thumbnail) and 'max_dimension' (max width/height of the transcode, None to keep the size)
+
+    --------------------------------
+
+    Return Values:
+    * Dictionary with the dimensions of the image, the paths ({path}.thumb{extension}, {path}{extension}), 
+    dimensions and byte sizes of the derivatives
+    """
+
+    image_format, extension = DERIVATIVE_FORMATS[options['format']]
+
+    with Image.open(path) as image:
+        width, height = image.size
+
+        # JPEG has no alpha channel, animated images are reduced to their first frame
+        has_alpha = image.mode in ('RGBA', 'LA', 'PA') or (image.mode == 'P' and 'transparency' in image.info)
+        image = image.convert('RGBA' if has_alpha and image_format == 'WEBP' else 'RGB')
+
+    transcode = image
+    if options.get('max_dimension') is not None and max(width, height) > options['max_dimension']:
+        transcode = image.copy()
+        transcode.thumbnail((options['max_dimension'], options['max_dimension']))
+    transcode_path = path + extension
+    transcode.save(transcode_path, image_format, quality = options['quality'])
+
+    thumbnail = image.copy()
+    thumbnail.thumbnail((options['thumbnail_size'], options['thumbnail_size']))
+    thumbnail_path = path + '.thumb' + extension
+    thumbnail.save(thumbnail_path, image_format, quality = options['quality'])
+
+    return {
+        'width': width,
+        'height': height,
+        'transcode': transcode_path,
+        'transcode_width': transcode.width,
+        'transcode_height': transcode.height,
+        'transcode_byte_size': os.path.getsize(transcode_path),
+        'thumbnail': thumbnail_path,
+        'thumbnail_width': thumbnail.width,
+        'thumbnail_height': thumbnail.height,
+        'thumbnail_byte_size': os.path.getsize(thumbnail_path)
+    }
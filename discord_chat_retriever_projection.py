@@ -0,0 +1,53 @@
+def compile_projection(fields):
+    """ Compile a list of retained fields into a function trimming Discord message objects
+
+    Keyword Arguments:
+    * fields: list -- Dotted paths of the fields to keep, e.g. ['id', 'content', 'author.id', 'attachments.url'].
+    A path through a list applies to every element of the list, a path ending on an object keeps the whole
+    object. The message 'id' is always kept.
+
+    --------------------------------
+
+    Return Values:
+    * Function taking a message object and returning the projected copy
+    """
+
+    # Build the field tree once, a None leaf keeps the whole value
+    tree = {'id': None}
+    for field in fields:
+        node = tree
+        parts = field.split('.')
+        for part in parts[ : -1]:
+            if part in node and node[part] is None:
+                # The whole parent object is already kept
+                break
+            node = node.setdefault(part, {})
+        else:
+            node[parts[-1]] = None
+
+    return _compile_node(tree)
+
+
+def _compile_node(tree):
+    """ Compile a level of the field tree into a projection function
+
+    Keyword Arguments:
+    * tree: dict -- Field name -> None (keep the value) or sub tree
+    """
+
+    leaves = tuple(key for key, sub_tree in tree.items() if sub_tree is None)
+    nested = tuple((key, _compile_node(sub_tree)) for key, sub_tree in tree.items() if sub_tree is not None)
+
+    def project(value):
+        if isinstance(value, list):
+            return [project(item) for item in value]
+        if not isinstance(value, dict):
+            return value
+
+        result = {key: value[key] for key in leaves if key in value}
+        for key, project_nested in nested:
+            if key in value:
+                result[key] = project_nested(value[key])
+        return result
+
+    return project
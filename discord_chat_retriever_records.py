@@ -0,0 +1,57 @@
+import json
+
+class MessageRecord:
+    """ Compact in-memory form of a Discord message used between the extract loop and the sinks
+
+    The hot attributes are kept as plain slots (integer snowflakes instead of strings), the full message is
+    kept as its compact JSON encoding and only decoded by the sinks that need the object. A buffered record
+    takes a fraction of the memory of the dictionary returned by response.json().
+    """
+
+    __slots__ = ('id', 'channel_id', 'author_id', 'type', 'content', 'edited_timestamp', 'payload')
+
+    def __init__(self, id, channel_id, author_id, type, content, edited_timestamp, payload):
+        self.id = id
+        self.channel_id = channel_id
+        self.author_id = author_id
+        self.type = type
+        self.content = content
+        self.edited_timestamp = edited_timestamp
+        self.payload = payload
+
+
+    @classmethod
+    def from_message(cls, message, channel_id):
+        """ Build a record from a Discord message object
+
+        Keyword Arguments:
+        * message: dict -- Discord message object
+        * channel_id: str -- Channel ID of the message
+
+        --------------------------------
+
+        Return Values:
+        * MessageRecord
+        """
+
+        author = message.get('author') or {}
+        if not isinstance(author, dict):
+            # Normalized users, the author is only referenced by ID
+            author = {'id': author}
+        return cls(int(message['id']),
+                    int(channel_id),
+                    int(author['id']) if 'id' in author else None,
+                    message.get('type'),
+                    message.get('content'),
+                    message.get('edited_timestamp'),
+                    json.dumps(message, separators = (',', ':')))
+
+
+    def message(self):
+        """ Decode the full message object
+
+        Return Values:
+        * The Discord message object
+        """
+
+        return json.loads(self.payload)
@@ -0,0 +1,189 @@
+from concurrent.futures import ProcessPoolExecutor
+from discord_chat_retriever_data_hub import DiscordChatRetrieverDataHub
+from google.cloud import storage
+
+import logging
+import multiprocessing
+import os
+import re
+
+class DiscordChatRetrieverReprocessor:
+
+    ###############################################
+    #####               CONSTANTS             #####
+    ###############################################
+    RAW_PREFIX = 'raw/'
+    DERIVED_FOLDER = 'derived/{}/' # Name of the dataset
+    WORK_FOLDER = 'reprocess/'
+    SETTINGS_FILE = 'configs/reprocess_settings.json'
+
+    # raw/YYYY-MM-DD/{channel}_{first}_{last}.json[l][.gz|.zst] or .dca
+    RAW_CHUNK_NAME_PATTERN = re.compile(r'^raw/(\d{4}-\d{2}-\d{2})/(\d+)_(\d+)_(\d+)(\.jsonl?(\.gz|\.zst)?|\.dca)$')
+
+    def __init__(self, data_hub, dataset):
+        """ Offline job running the raw archive (see DiscordChatRetrieverDataHub.raw_archive) through new
+        filters and projection into a derived dataset, without requesting Discord
+
+        The settings of the derived dataset are read from configs/reprocess_settings.json, with the same keys
+        as the crawler settings (message_filter, regex_filter_expression, message_projection, output_format...)
+
+        Keyword Arguments:
+        * data_hub: DiscordChatRetrieverDataHub -- Data hub used for reading/writing chunks
+        * dataset: str -- Name of the derived dataset, written to derived/{dataset}/
+        """
+
+        self.data_hub = data_hub
+        self.dataset = dataset
+        self.max_workers = os.cpu_count()
+
+
+    def reprocess(self):
+        """ Reprocess the raw chunks of every channel
+
+        Steps:
+        1. List the raw chunk objects in GCP Storage and group them by channel
+        2. Reprocess the channels in parallel processes (see reprocess_channel)
+        """
+
+        logging.info("Reprocessing raw chunks into dataset {} (Bucket: {}, Prefix: {})".format(
+            self.dataset,
+            self.data_hub.BUCKET_NAME,
+            self.RAW_PREFIX))
+
+        # Make sure the reprocess settings are the latest ones
+        self.data_hub._sync_folder_down(self.data_hub.BUCKET_NAME, 'configs/', 'configs/')
+        if not os.path.isfile(self.SETTINGS_FILE):
+            logging.warning("No reprocess settings ({}), the dataset is an unfiltered copy of the raw archive".format(self.SETTINGS_FILE))
+
+        # List the raw chunk objects and group them by channel
+        storage_client = storage.Client()
+        bucket = storage_client.bucket(self.data_hub.BUCKET_NAME)
+        chunks_per_channel = {}
+        for blob in bucket.list_blobs(prefix = self.RAW_PREFIX):
+            match = self.RAW_CHUNK_NAME_PATTERN.match(blob.name)
+            if match is None:
+                continue
+            chunks_per_channel.setdefault(match.group(2), []).append(blob.name)
+
+        logging.info("Found raw chunks for {} channels".format(len(chunks_per_channel)))
+
+        # Reprocess the channels in parallel, filtering is CPU bound. Spawn the processes, a forked child could
+        # inherit a lock held by another thread (the Cloud Logging transport) and deadlock
+        with ProcessPoolExecutor(max_workers = self.max_workers, mp_context = multiprocessing.get_context('spawn')) as executor:
+            futures = {executor.submit(reprocess_channel, self.dataset, channel, chunks): channel
+                        for channel, chunks in chunks_per_channel.items()}
+            for future in futures:
+                try:
+                    logging.info("Reprocessed channel {}: kept {} of {} messages".format(futures[future], *future.result()))
+                except BaseException as e:
+                    logging.error("Error while reprocessing channel {}: {}".format(futures[future], e))
+
+
+    def reprocess_channel(self, channel, chunks):
+        """ Run the raw chunks of a channel through the filters and the projection of the data hub
+
+        Keyword Arguments:
+        * channel: str -- Channel ID
+        * chunks: list -- Names of the raw chunk objects of the channel
+
+        --------------------------------
+
+        Steps:
+        1. Download the raw chunks one at a time, newest first
+        2. Drop the messages already seen in a newer chunk (an interrupted extraction may archive a message twice)
+        3. Filter the messages (unless the data hub has no filters) and write them to the chunk sink of the dataset, every full chunk is uploaded
+        to derived/{dataset}/{channel}_{first}_{last}{extension}
+
+        --------------------------------
+
+        Return Values:
+        * Tuple of the number of messages kept and the number of messages read
+        """
+
+        storage_client = storage.Client()
+        bucket = storage_client.bucket(self.data_hub.BUCKET_NAME)
+        work_folder = self.WORK_FOLDER + '{}/'.format(channel)
+
+        # Newest chunks first, the sinks expect the messages newest first
+        chunks = sorted(chunks, key = lambda name: int(self.RAW_CHUNK_NAME_PATTERN.match(name).group(4)), reverse = True)
+
+        chunk_sink = None
+        seen = set()
+        read_count = 0
+        kept_count = 0
+        try:
+            for name in chunks:
+                local_path = work_folder + name
+                self.data_hub._create_folder(os.path.dirname(local_path))
+                # Download the stored bytes, objects uploaded with a Content-Encoding would be decompressed otherwise
+                bucket.blob(name).download_to_filename(local_path, raw_download = True)
+                chunk = self.data_hub._read_chunk_file(local_path)
+                os.remove(local_path)
+
+                if chunk_sink is None:
+                    chunk_sink = self.data_hub._create_chunk_sink(chunk, self.DERIVED_FOLDER.format(self.dataset))
+                    chunk_sink.commit = self._commit_derived_chunk
+
+                page = []
+                for message in reversed(chunk['messages']):
+                    snowflake = int(message['id'])
+                    if snowflake not in seen:
+                        seen.add(snowflake)
+                        page.append(message)
+                read_count += len(page)
+
+                if self.data_hub.page_filter is not None:
+                    page = self.data_hub.page_filter.filter_page(page)
+                for message in page:
+                    self.data_hub._write_message(chunk_sink, message)
+                    kept_count += 1
+
+            if chunk_sink is not None:
+                self._commit_derived_chunk(chunk_sink)
+        finally:
+            self.data_hub.delete_folder(work_folder)
+
+        return kept_count, read_count
+
+
+    def _commit_derived_chunk(self, chunk_sink):
+        """ Finalize the current chunk of the dataset and upload it
+
+        Keyword Arguments:
+        * chunk_sink: ChunkSink -- Sink of the channel in the dataset
+        """
+
+        chunk = chunk_sink.close()
+        if chunk is None:
+            return
+
+        for path in (chunk['path'], chunk.get('users_path')):
+            if path is not None:
+                self.data_hub._upload_file(self.data_hub.BUCKET_NAME, path, path)
+                os.remove(path)
+
+
+def reprocess_channel(dataset, channel, chunks):
+    """ Reprocess a channel in a worker process, with a data hub of its own configured by the reprocess settings
+
+    Keyword Arguments:
+    * dataset: str -- Name of the derived dataset
+    * channel: str -- Channel ID
+    * chunks: list -- Names of the raw chunk objects of the channel
+
+    --------------------------------
+
+    Return Values:
+    * Tuple of the number of messages kept and the number of messages read
+    """
+
+    data_hub = DiscordChatRetrieverDataHub()
+    data_hub._load_crawler_settings(DiscordChatRetrieverReprocessor.SETTINGS_FILE)
+
+    # Without reprocess settings every raw message is kept, the default filters drop those without content
+    if not os.path.isfile(DiscordChatRetrieverReprocessor.SETTINGS_FILE):
+        data_hub.page_filter = None
+
+    # The local message store is not shared between the worker processes
+    data_hub.message_store_path = None
+    return DiscordChatRetrieverReprocessor(data_hub, dataset).reprocess_channel(channel, chunks)
@@ -0,0 +1,552 @@
+from datetime import datetime, timezone
+from discord_chat_retriever_archive import write_archive
+
+import json
+import logging
+import os
+import sqlite3
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+class ChunkSink:
+    """ Base class of the chunk sinks, a sink receives the messages of a channel and writes them to chunk files
+
+    A chunk file is opened on the first message written after a rotation and finalized by close(). The chunk
+    is committed by the commit function of the sink, by default the data hub (see 
+    DiscordChatRetrieverDataHub._commit_chunk), once it is full by message count or byte size. A finalized chunk is named after its channel and snowflake range, so writing the
+    same range again produces the same file.
+    """
+
+    EXTENSION = ''
+
+    def __init__(self, data_hub, folder, header):
+        """ Create a sink for a channel
+
+        Keyword Arguments:
+        * data_hub: DiscordChatRetrieverDataHub -- Data hub providing the file helpers and output settings
+        * folder: str -- Folder to write the chunk files to
+        * header: dict -- Channel information (see DiscordChatRetrieverDataHub._create_base_message_json)
+        """
+
+        self.data_hub = data_hub
+        self.folder = folder
+        self.header = {key: value for key, value in header.items() if key != 'messages'}
+        self.path = None
+        self.commit = data_hub._commit_chunk
+
+        # Sink of the raw archive of the channel, committed before every chunk of this sink (see raw_archive)
+        self.raw_sink = None
+        self._reset()
+
+
+    def _reset(self):
+        """ Reset the statistics of the current chunk """
+
+        self.message_count = 0
+        self.byte_count = 0
+        self.first_snowflake = None
+        self.last_snowflake = None
+
+        # Users referenced by the messages of the chunk when users are normalized (user ID -> encoded user)
+        self.users = {}
+
+        # Downloads of the attachments of the chunk (see MediaDownloadPool.submit)
+        self.media = []
+
+
+    def write(self, record, users = None, media = None):
+        """ Add a message to the current chunk, opening a new chunk file if needed
+
+        Keyword Arguments:
+        * record: MessageRecord -- Message to write (see discord_chat_retriever_records)
+        * users: dict -- Users referenced by the message when users are normalized (user ID -> encoded user)
+        * media: list -- Downloads of the attachments of the message, the chunk is committed once they are done
+        """
+
+        # Commit the current chunk first if the message doesn't belong to it
+        if self.path is not None and not self._fits_current_chunk(record):
+            self.commit(self)
+
+        if self.path is None:
+            self.path = self._chunk_path(record)
+            self._open()
+
+        if users:
+            self.users.update(users)
+        if media:
+            self.media.extend(media)
+        self._write(record)
+
+        # Keep the snowflake range of the chunk in chronological order
+        if self.first_snowflake is None or record.id < self.first_snowflake:
+            self.first_snowflake = record.id
+        if self.last_snowflake is None or record.id > self.last_snowflake:
+            self.last_snowflake = record.id
+        self.message_count += 1
+
+        # Rotate the chunk once it reached the target message count or byte size
+        if self._is_full():
+            self.commit(self)
+
+
+    def close(self):
+        """ Finalize the current chunk file
+
+        Return Values:
+        * Dictionary with the path, first/last snowflake and message count of the finalized chunk file, 
+        None if no message was written since the last rotation
+        """
+
+        if self.path is None:
+            return None
+
+        self._close()
+
+        # Name the finalized chunk after its snowflake range
+        path = self._final_path()
+        os.replace(self.path, path)
+        if self.data_hub.fsync_on_rotate:
+            self._fsync(path)
+
+        chunk = {
+            'path': path,
+            'first_snowflake': str(self.first_snowflake),
+            'last_snowflake': str(self.last_snowflake),
+            'message_count': self.message_count
+        }
+        if self.users:
+            chunk['users_path'] = self._write_users()
+        self.path = None
+        self._reset()
+        return chunk
+
+
+    def _fits_current_chunk(self, record):
+        """ Whether a message can be added to the current chunk, sinks splitting their files by another
+        criterion than the data hub rotation override this
+
+        Keyword Arguments:
+        * record: MessageRecord -- Message about to be written
+        """
+
+        return True
+
+
+    def _is_full(self):
+        """ Whether the current chunk must be committed, by the rotation of the data hub (see
+        DiscordChatRetrieverDataHub._chunk_is_full) unless the sink rotates by another criterion """
+
+        return self.data_hub._chunk_is_full(self)
+
+
+    def _chunk_path(self, record):
+        """ Path of the chunk file while it is written: {folder}/{channel}_partial{extension}
+
+        Keyword Arguments:
+        * record: MessageRecord -- First message of the chunk
+        """
+
+        return self.folder + '{}_partial{}'.format(self.header['channel_id'], self._file_extension())
+
+
+    def _final_path(self):
+        """ Path of the finalized chunk file: {folder}/{channel}_{first snowflake}_{last snowflake}{extension} """
+
+        return self.folder + '{}_{}_{}{}'.format(
+            self.header['channel_id'], 
+            self.first_snowflake, 
+            self.last_snowflake, 
+            self._file_extension())
+
+
+    def _write_users(self):
+        """ Write the users referenced by the chunk next to it: {folder}/users/{channel}_{first}_{last}.json[.gz|.zst]
+
+        Return Values:
+        * Path of the users file
+        """
+
+        folder = self.folder + 'users/'
+        path = folder + '{}_{}_{}.json'.format(self.header['channel_id'], self.first_snowflake, self.last_snowflake)
+        if self.data_hub.output_compression is not None:
+            path += self.data_hub.COMPRESSION_EXTENSIONS[self.data_hub.output_compression]
+
+        # The users are already encoded, write them as a JSON list
+        self.data_hub._create_folder(folder)
+        with self.data_hub._open_output_file(path, self.data_hub.output_compression) as f:
+            f.write('[' + ','.join(self.users.values()) + ']')
+        return path
+
+
+    def _file_extension(self):
+        """ Extension of the chunk files, with the compression suffix ([.gz|.zst]) if compressed """
+
+        extension = self.EXTENSION
+        if self.data_hub.output_compression is not None:
+            extension += self.data_hub.COMPRESSION_EXTENSIONS[self.data_hub.output_compression]
+        return extension
+
+
+    def _fsync(self, path):
+        """ Flush a closed file to disk so a rotated chunk survives a crash of the machine """
+
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+    def _open(self):
+        raise NotImplementedError
+
+
+    def _write(self, record):
+        raise NotImplementedError
+
+
+    def _close(self):
+        raise NotImplementedError
+
+
+class JsonChunkSink(ChunkSink):
+    """ Buffers the encoded messages of a chunk and writes them as a single JSON object in chronological order
+
+    The output is the same as dumping the chunk object with _write_file: pretty printed when uncompressed,
+    compact when compressed. Only the encoded payloads are buffered, a message is decoded again only to
+    pretty print it.
+    """
+
+    EXTENSION = '.json'
+
+    def _open(self):
+        self.payloads = []
+
+
+    def _write(self, record):
+        self.payloads.append(record.payload)
+        self.byte_count += len(record.payload)
+
+
+    def _close(self):
+        # Reverse the messages so that the messages are in chronological order
+        self.payloads.reverse()
+
+        logging.info("Writing file: {}".format(self.path))
+        self.data_hub._create_folder(self.folder)
+        with self.data_hub._open_output_file(self.path, self.data_hub.output_compression) as f:
+            if self.data_hub.output_compression is None:
+                self._write_pretty(f)
+            else:
+                self._write_compact(f)
+        self.payloads = []
+
+
+    def _write_compact(self, f):
+        header = json.dumps(self.header, separators = (',', ':'))
+        f.write(header[ : -1] + ',"messages":[')
+        f.write(','.join(self.payloads))
+        f.write(']}')
+
+
+    def _write_pretty(self, f):
+        f.write('{\n')
+        for key, value in self.header.items():
+            f.write('    {}: {},\n'.format(json.dumps(key), json.dumps(value)))
+        f.write('    "messages": [\n')
+        for index, payload in enumerate(self.payloads):
+            message = json.dumps(json.loads(payload), indent = 4).replace('\n', '\n        ')
+            f.write('        ' + message + (',\n' if index < len(self.payloads) - 1 else '\n'))
+        f.write('    ]\n}')
+
+
+class JsonLinesChunkSink(ChunkSink):
+    """ Writes the messages of a chunk incrementally as JSON Lines, one compact message per line
+
+    The first line is a header record with the channel information. Messages are written in the order they
+    are requested (newest first), which the header records as 'order'. Nothing but the open file is held
+    in memory, and the file can be read by streaming readers (jq, Spark, BigQuery loads) line by line.
+    """
+
+    EXTENSION = '.jsonl'
+
+    def _open(self):
+        self.data_hub._create_folder(self.folder)
+        self.file = self.data_hub._open_output_file(self.path, self.data_hub.output_compression)
+
+        header = {'record': 'header', 'order': 'newest_first'}
+        header.update(self.header)
+        self.file.write(json.dumps(header, separators = (',', ':')) + '\n')
+
+
+    def _write(self, record):
+        self.file.write(record.payload)
+        self.file.write('\n')
+        self.byte_count += len(record.payload) + 1
+
+
+    def _close(self):
+        logging.info("Closing JSON Lines chunk: {}".format(self.path))
+        self.file.close()
+        self.file = None
+
+
+class ParquetChunkSink(ChunkSink):
+    """ Flattens the messages into a typed columnar schema and writes them as row grouped Parquet files
+
+    A chunk file holds the messages of one time window (day or month, from parquet_time_window), a message
+    of another window rotates the chunk. NUM_MESSAGES_PER_FILE doesn't apply, a window is only split when
+    the chunk reaches MAX_BYTES_PER_FILE (size of the encoded messages). Rows are buffered up to 
+    parquet_row_group_size and written as a row group, the compression codec follows output_compression 
+    (snappy when None).
+    """
+
+    EXTENSION = '.parquet'
+    CODECS = {None: 'snappy', 'gzip': 'gzip', 'zstd': 'zstd'}
+    WINDOW_FORMATS = {'day': '%Y-%m-%d', 'month': '%Y-%m'}
+    DISCORD_EPOCH = 1420070400000
+
+    SCHEMA = None if pyarrow is None else pyarrow.schema([
+        ('id', pyarrow.int64()),
+        ('guild_id', pyarrow.int64()),
+        ('channel_id', pyarrow.int64()),
+        ('timestamp', pyarrow.timestamp('ms', tz = 'UTC')),
+        ('edited_timestamp', pyarrow.timestamp('ms', tz = 'UTC')),
+        ('type', pyarrow.int32()),
+        ('author_id', pyarrow.int64()),
+        ('author_username', pyarrow.string()),
+        ('author_bot', pyarrow.bool_()),
+        ('content', pyarrow.string()),
+        ('pinned', pyarrow.bool_()),
+        ('attachment_count', pyarrow.int32()),
+        ('embed_count', pyarrow.int32()),
+        ('mention_count', pyarrow.int32()),
+        ('reaction_count', pyarrow.int32()),
+        ('reference_message_id', pyarrow.int64())
+    ])
+
+    def _window(self, record):
+        """ Time window of a message, derived from its snowflake """
+
+        timestamp = datetime.fromtimestamp(((record.id >> 22) + self.DISCORD_EPOCH) / 1000, tz = timezone.utc)
+        return timestamp.strftime(self.WINDOW_FORMATS[self.data_hub.parquet_time_window])
+
+
+    def _fits_current_chunk(self, record):
+        return self._window(record) == self.window
+
+
+    def _is_full(self):
+        # Rotate by time window, capped by byte size only
+        max_bytes = self.data_hub.MAX_BYTES_PER_FILE
+        return max_bytes is not None and self.byte_count >= max_bytes
+
+
+    def _chunk_path(self, record):
+        self.window = self._window(record)
+        return super()._chunk_path(record)
+
+
+    def _file_extension(self):
+        # Parquet compresses its column chunks itself
+        return self.EXTENSION
+
+
+    def _open(self):
+        if pyarrow is None:
+            raise ValueError("The parquet output format requires the pyarrow package")
+
+        self.data_hub._create_folder(self.folder)
+        self.writer = pyarrow.parquet.ParquetWriter(self.path, 
+                                                    self.SCHEMA, 
+                                                    compression = self.CODECS[self.data_hub.output_compression])
+        self.rows = []
+
+
+    def _write(self, record):
+        message = record.message()
+        author = message.get('author') or {}
+        if not isinstance(author, dict):
+            # Normalized users, the author is only referenced by ID
+            author = json.loads(self.users.get(author, '{}'))
+        reference = message.get('message_reference') or {}
+
+        self.rows.append({
+            'id': record.id,
+            'guild_id': int(self.header['guild_id']),
+            'channel_id': record.channel_id,
+            'timestamp': (record.id >> 22) + self.DISCORD_EPOCH,
+            'edited_timestamp': None if record.edited_timestamp is None else datetime.fromisoformat(record.edited_timestamp),
+            'type': record.type,
+            'author_id': record.author_id,
+            'author_username': author.get('username'),
+            'author_bot': author.get('bot', False),
+            'content': record.content,
+            'pinned': message.get('pinned'),
+            'attachment_count': len(message.get('attachments') or []),
+            'embed_count': len(message.get('embeds') or []),
+            'mention_count': len(message.get('mentions') or []),
+            'reaction_count': sum(r.get('count', 0) for r in message.get('reactions') or []),
+            'reference_message_id': int(reference['message_id']) if 'message_id' in reference else None
+        })
+
+        self.byte_count += len(record.payload)
+
+        if len(self.rows) >= self.data_hub.parquet_row_group_size:
+            self._write_row_group()
+
+
+    def _write_row_group(self):
+        self.writer.write_table(pyarrow.Table.from_pylist(self.rows, schema = self.SCHEMA))
+        self.rows = []
+
+
+    def _close(self):
+        if len(self.rows) > 0:
+            self._write_row_group()
+        self.writer.close()
+        self.writer = None
+
+
+class ArchiveChunkSink(ChunkSink):
+    """ Buffers the encoded messages of a chunk and writes them as a compact binary archive (see
+    discord_chat_retriever_archive) for long term storage
+
+    The archive is compressed with zstd when output_compression is 'zstd', with zlib otherwise.
+    """
+
+    EXTENSION = '.dca'
+
+    def _open(self):
+        self.payloads = []
+
+
+    def _write(self, record):
+        self.payloads.append(record.payload)
+        self.byte_count += len(record.payload)
+
+
+    def _file_extension(self):
+        # The archive compresses its blocks itself
+        return self.EXTENSION
+
+
+    def _close(self):
+        logging.info("Writing archive: {}".format(self.path))
+        self.data_hub._create_folder(self.folder)
+
+        codec = 'zstd' if self.data_hub.output_compression == 'zstd' else 'zlib'
+        level = self.data_hub.output_compression_level
+        if level is None:
+            level = 19 if codec == 'zstd' else 9
+        write_archive(self.path, self.header, (json.loads(payload) for payload in self.payloads), codec, level)
+        self.payloads = []
+
+
+class SQLiteMessageStore:
+    """ Local queryable copy of the crawled messages, upserted into a SQLite database keyed by snowflake
+
+    Messages are inserted in batched transactions on a WAL journal, re-crawled messages replace the stored
+    row through the primary key. The (channel_id, id) and author_id indexes serve the usual lookups.
+    """
+
+    DISCORD_EPOCH = 1420070400000
+
+    def __init__(self, path, batch_size = 1000):
+        """ Open (and create if needed) the message store
+
+        Keyword Arguments:
+        * path: str -- Path of the SQLite database
+        * batch_size: int -- Number of messages inserted per transaction
+        """
+
+        logging.info("Opening message store: {}".format(path))
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+
+        self.batch_size = batch_size
+        self.batch = []
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode = WAL')
+        self.connection.execute('PRAGMA synchronous = NORMAL')
+        with self.connection:
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS messages (
+                    id INTEGER PRIMARY KEY,
+                    guild_id INTEGER,
+                    channel_id INTEGER NOT NULL,
+                    author_id INTEGER,
+                    timestamp INTEGER NOT NULL,
+                    edited_timestamp TEXT,
+                    type INTEGER,
+                    content TEXT,
+                    payload TEXT NOT NULL
+                )""")
+            self.connection.execute('CREATE INDEX IF NOT EXISTS messages_channel_id ON messages (channel_id, id)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS messages_author_id ON messages (author_id)')
+
+
+    def add(self, header, record):
+        """ Queue a message for insertion, the batch is written once it is full
+
+        Keyword Arguments:
+        * header: dict -- Channel information (see DiscordChatRetrieverDataHub._create_base_message_json)
+        * record: MessageRecord -- Message to store (see discord_chat_retriever_records)
+        """
+
+        self.batch.append((
+            record.id,
+            int(header['guild_id']),
+            record.channel_id,
+            record.author_id,
+            (record.id >> 22) + self.DISCORD_EPOCH,
+            record.edited_timestamp,
+            record.type,
+            record.content,
+            record.payload
+        ))
+
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+
+    def flush(self):
+        """ Upsert the queued messages in a single transaction """
+
+        if len(self.batch) == 0:
+            return
+
+        with self.connection:
+            self.connection.executemany("""
+                INSERT INTO messages (id, guild_id, channel_id, author_id, timestamp, edited_timestamp, type, content, payload)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (id) DO UPDATE SET
+                    guild_id = excluded.guild_id,
+                    channel_id = excluded.channel_id,
+                    author_id = excluded.author_id,
+                    edited_timestamp = excluded.edited_timestamp,
+                    type = excluded.type,
+                    content = excluded.content,
+                    payload = excluded.payload""", self.batch)
+        self.batch = []
+
+
+    def close(self):
+        """ Write the remaining messages and close the database """
+
+        self.flush()
+        self.connection.close()
+
+
+# Sink class per output format
+CHUNK_SINKS = {
+    'json': JsonChunkSink,
+    'jsonl': JsonLinesChunkSink,
+    'parquet': ParquetChunkSink,
+    'archive': ArchiveChunkSink
+}